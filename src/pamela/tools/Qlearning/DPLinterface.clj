@@ -246,7 +246,51 @@
       (def fresh-data-promises (merge fresh-data-promises {plant-id apromise})))
     (deref apromise)))                     ; Block until the data is ready
 
-(defn incoming-msgs [_ metadata ^bytes payload]
+(def binary-content-type "application/x-binary")
+
+;;; Results of train-episodes, by call id, see decode-qtable-result
+(def qtable-results-lock (Object.))
+(def qtable-results {})
+
+(defn decode-qtable-result
+  "Decode a plant's binary train-episodes result, the DMRQ layout of test-plants/qlearning.py"
+  [^bytes payload]
+  (let [buf (doto (java.nio.ByteBuffer/wrap payload) (.order java.nio.ByteOrder/LITTLE_ENDIAN))
+        magic (String. payload 0 4 "US-ASCII")
+        version (.get buf 4)
+        length (.getInt buf 8)
+        description (json/read-str (String. payload 12 length "UTF-8"))
+        n (get description "num-episodes")
+        qsize (reduce * (get description "q-shape"))]
+    (if (not (and (= magic "DMRQ") (= version 1)))
+      (throw (Exception. (str "Not a version 1 Q-table message: " magic " " version))))
+    (.position buf (int (+ 12 length)))
+    {:description description
+     :q-shape (get description "q-shape")
+     :q-table (vec (repeatedly qsize #(.getFloat buf)))     ; C order, the last index is the action
+     :rewards (vec (repeatedly n #(.getDouble buf)))
+     :steps (vec (repeatedly n #(.getInt buf)))
+     :succeeded (vec (repeatedly n #(= 1 (.get buf))))
+     :epsilons (vec (repeatedly n #(.getDouble buf)))}))
+
+(defn take-qtable-result
+  [id]
+  (locking qtable-results-lock
+    (let [result (get qtable-results id)]
+      (def qtable-results (dissoc qtable-results id))
+      result)))
+
+;;; Binary payloads (frames, Q-tables) are not JSON, they must not reach json/read-str
+(defn incoming-binary-msg [metadata ^bytes payload]
+  (if (= (:routing-key metadata) "gym.qtable")
+    (try
+      (let [result (decode-qtable-result payload)]
+        (locking qtable-results-lock
+          (def qtable-results (merge qtable-results {(str (get (:description result) "id")) result}))))
+      (catch Exception e
+        (println "Bad Q-table message:" (.getMessage e))))))
+
+(defn incoming-json-msg [metadata ^bytes payload]
   (def received-count (inc received-count))
   #_(when (zero? (mod received-count 1000))
       (println "Messages received so far" received-count)
@@ -296,11 +340,19 @@
                                (let [oldpromise (get fresh-data-promises plantid)]
                                  (def fresh-data-promises (dissoc fresh-data-promises plantid))
                                  oldpromise))]
-                (if apromise (deliver apromise plantid))))))
+                (if apromise (deliver apromise plantid)))
+              ;; In delta mode the plant finishes the command in the observations message itself
+              (if-let [finished (get m "finished")]
+                (function-finished (str (get finished "id")) (get finished "reason"))))))
        ;; :else (println "plantid=" plantid "plantifid="  plantifid (if (= plantid plantifid) "same" "different") "observations=" (if observations (fromjson/map-from-json-str observations)))
       )
     (check-for-satisfied-activities)))
 
+(defn incoming-msgs [_ metadata ^bytes payload]
+  (if (= (:content-type metadata) binary-content-type)
+    (incoming-binary-msg metadata payload)
+    (incoming-json-msg metadata payload)))
+
 (defn rabbitMQ-connect
   [host port ch-name plantifid]
   (set-plantifid plantifid)
@@ -321,7 +373,8 @@
 
 (def call-counter 10)
 
-(defn bp-call
+(defn bp-call-with-id
+  "As bp-call, returns [id result] so that replies published apart can be looked up by call id"
   [self pid function args]
   (let [id (do (locking call-lock
                  (def call-counter (+ call-counter 1))
@@ -336,6 +389,20 @@
       :exchange exchange
       :function-name function
       :args args} routing channel exchange)
-    (deref finished)))
+    [id (deref finished)]))
+
+(defn bp-call
+  [self pid function args]
+  (second (bp-call-with-id self pid function args)))
+
+(defn bp-call-qtable
+  "Call a function that replies with a binary Q-table result, returns the decoded result or nil on failure"
+  [self pid function args]
+  (let [[id reason] (bp-call-with-id self pid function args)]
+    (if (= (get reason "finish-state") "success")
+      (take-qtable-result id)
+      (do (println function "failed:" (get reason "failed-reason"))
+          (take-qtable-result id)
+          nil))))
 
 ;;; Fin
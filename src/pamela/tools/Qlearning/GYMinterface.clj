@@ -43,6 +43,14 @@
   (DPL/bp-call self "gym" "perform-action" [action])
   (if (> cycletime 0) (Thread/sleep cycletime)))
 
+;;; Invoke a sequence of actions, or one action repeated k times, in one round trip.
+;;; The plant stops early when the episode ends.
+(defn perform-actions
+  ([self actions]
+   (DPL/bp-call self "gym" "perform-actions" [actions]))
+  ([self action k]
+   (DPL/bp-call self "gym" "perform-actions" [action k])))
+
 ;; reset the simulator for the next episode
 (defn reset
   [self]
@@ -58,6 +66,14 @@
   [self prompt]
   (DPL/bp-call self "gym" "ask-gpt" [prompt]))
 
+;;; Train whole episodes in the plant, params is a map of the hyperparameters
+;;; ("discretization" "alpha" "gamma" "epsilon" "explore" "max-steps" "num-episodes" and optionally
+;;; "q-table" "start-episode" "episodes" "low" "high" "seed").  Returns the decoded result, with the
+;;; trained :q-table and the per-episode :rewards :steps :succeeded :epsilons, or nil on failure.
+(defn train-episodes
+  [self params]
+  (DPL/bp-call-qtable self "gym" "train-episodes" [params]))
+
 ;;; shutdown the simulator - NYI
 (defn shutdown
   [self]
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Dynamic Object Language Labs Inc.
+#
+# This software is licensed under the terms of the
+# Apache License, Version 2.0 which can be found in
+# the file LICENSE at the root of this distribution.
+
+import asyncio
+import threading
+import time
+import concurrent.futures
+
+import plant
+
+'''
+asyncio flavour of plant.Plant
+
+Same started/finished/failed/observations API and the same transports as
+Plant, so it runs on RabbitMQ or on a transport.LoopbackTransport.  The
+transport is driven by a connection thread of its own, which consumes,
+acks and publishes; commands are handed over to the event loop and
+messages from the loop go out through Plant's outbound queue.
+
+Incoming commands are queued on a lane per plant-id and each lane is
+worked by its own task, so commands for one plant-id run in order while
+different plant-ids proceed concurrently.  The callback may be a plain
+function or a coroutine function.  Commands named in executor_functions
+are run in a thread pool so that they do not block the event loop, and
+commands named in independent_functions get a lane of their own so that
+they do not hold up the other commands of their plant-id either.  A
+close command drops the lanes of its plant-id.
+'''
+
+
+class AsyncPlant(plant.Plant):
+    def __init__(self, plantid, exchange, host='localhost', port=5672,
+                 executor_functions=('ask-gpt', 'render'), independent_functions=('ask-gpt',), max_workers=4,
+                 **plant_options):
+        plant.Plant.__init__(self, plantid, exchange, host, port, **plant_options)
+        self.executor_functions = set(executor_functions)
+        self.independent_functions = set(independent_functions)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.lanes = {}                 # lane key -> asyncio.Queue of (msg, routing key, delivery tag)
+        self.lane_tasks = set()
+        self.loop = None
+        self.loop_thread = None
+        self.connection_thread = None
+        self.closed = None              # future completed when the connection thread stops consuming
+        self.metrics.gauge('plant_lanes', lambda: len(self.lanes), 'command lanes of the asyncio plant')
+
+    async def run(self, cb_fn_name, keys=()):
+        """
+        Consume commands and dispatch them to cb_fn_name until the connection closes.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.current_thread()
+        self.closed = self.loop.create_future()
+        self.subscribe(keys)
+        self.myprint()
+        print("Waiting for commands")
+        self.cb_function = cb_fn_name
+        if self.prefetch_count > 0:
+            self.transport.set_prefetch(self.prefetch_count)
+        self.transport.consume(self.qname, self.message_receiver_internal)
+        self.schedule_metrics_report()
+        # From here on the transport belongs to the connection thread, messages published on the
+        # event loop are enqueued for it like those of any other thread
+        self.connection_thread = threading.Thread(target=self.consume, name='plant-connection', daemon=True)
+        self.channel_thread = self.connection_thread
+        self.connection_thread.start()
+        try:
+            await self.closed
+        finally:
+            for task in self.lane_tasks:
+                task.cancel()
+
+    def consume(self):
+        self.wait_until_keyboard_interrupt()
+        self.loop.call_soon_threadsafe(self.set_closed)
+
+    def set_closed(self):
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    # Dispatch
+
+    def lane_key(self, msg):
+        plid = self.get_plantId(msg)
+        fn_name = msg.get('function-name')
+        if fn_name in self.independent_functions:
+            return str(plid) + '/' + fn_name
+        return plid
+
+    def message_receiver_internal(self, channel, method, properties, body):
+        # On the connection thread
+        msg = plant.to_object(body)
+        self.record_received(msg)
+        self.loop.call_soon_threadsafe(self.enqueue, msg, method.routing_key, method.delivery_tag)
+
+    def enqueue(self, msg, routing_key, delivery_tag):
+        key = self.lane_key(msg)
+        lane = self.lanes.get(key)
+        if lane is None:
+            lane = asyncio.Queue()
+            self.lanes[key] = lane
+            task = self.loop.create_task(self.work_lane(key, lane))
+            self.lane_tasks.add(task)
+            task.add_done_callback(self.lane_tasks.discard)
+        lane.put_nowait((msg, routing_key, delivery_tag))
+
+    async def work_lane(self, key, lane):
+        while not self.done:
+            item = await lane.get()
+            if item is None:
+                return                  # The lane was dropped
+            msg, routing_key, delivery_tag = item
+            t0 = time.perf_counter()
+            try:
+                if msg.get('function-name') in self.executor_functions:
+                    await self.loop.run_in_executor(self.executor, self.cb_function, msg, routing_key)
+                else:
+                    result = self.cb_function(msg, routing_key)
+                    if asyncio.iscoroutine(result):
+                        await result
+            except Exception as e:
+                print('Command failed', msg.get('function-name'), e.__class__.__name__ + ": " + str(e))
+                self.failed(msg, e.__class__.__name__ + ": " + str(e))
+            finally:
+                self.metrics.observe('plant_handler_seconds', time.perf_counter() - t0,
+                                     function=msg.get('function-name'))
+                # Lanes finish out of order, so each message is acked on its own
+                self.transport_call(self.ack_message, delivery_tag)
+            if msg.get('function-name') == 'close' and self.drop_lanes(self.get_plantId(msg), key, lane):
+                return
+
+    def ack_message(self, delivery_tag):
+        if self.transport.is_open():        # Not after close
+            self.transport.ack(delivery_tag)
+
+    def drop_lanes(self, plid, key, lane):
+        """
+        Drop the lanes of plid after its close, returns True when the calling lane was dropped.
+        The plant-id's own lane is kept while commands are queued behind the close, so that they
+        run in order; independent lanes finish their queued commands first.
+        """
+        for other in [k for k in self.lanes if k != key and str(k).startswith(str(plid) + '/')]:
+            self.lanes.pop(other).put_nowait(None)
+        if key == plid and lane.empty():
+            del self.lanes[key]
+            return True
+        return False
+
+    def transport_call(self, fn, *args):
+        # The transport is only used on the connection thread
+        if threading.current_thread() is self.connection_thread:
+            fn(*args)
+        else:
+            self.transport.add_callback_threadsafe(lambda: fn(*args))
+
+    def call_later(self, delay, callback):
+        # Timers run on the event loop, in step with the commands
+        if threading.current_thread() is self.loop_thread:
+            self.loop.call_later(delay, callback)
+        else:
+            self.loop.call_soon_threadsafe(self.loop.call_later, delay, callback)
+
+    def run_blocking(self, fn, *args):
+        """
+        Run fn(*args) in the plant's thread pool, returns an awaitable.
+        """
+        return self.loop.run_in_executor(self.executor, fn, *args)
+
+    def close(self):
+        self.done = True
+        self.executor.shutdown(wait=False)
+        if self.connection_thread is not None and self.connection_thread.is_alive():
+            self.transport_call(plant.Plant.close, self)
+        else:
+            plant.Plant.close(self)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Dynamic Object Language Labs Inc.
+#
+# This software is licensed under the terms of the
+# Apache License, Version 2.0 which can be found in
+# the file LICENSE at the root of this distribution.
+
+import collections
+import copy
+import json
+import gymnasium as gym
+
+'''
+Cache of gym environment instances for the gym plant
+
+Instances are keyed by (env name, render mode, gym.make kwargs), so that a
+plant switching between headless training and human rendering reuses the
+instance it already built instead of closing it and calling gym.make again.
+The most recently used instance is the one in use; up to max_idle others are
+kept and the least recently used beyond that are closed.
+
+When switching instances mid-episode, the simulator state is carried over
+for envs that keep it in unwrapped.state, as the classic control envs do,
+along with the TimeLimit step count.  Other envs are reset.
+'''
+
+
+def env_key(name, render_mode=None, kwargs=None):
+    return (name, render_mode, json.dumps(kwargs or {}, sort_keys=True))
+
+
+def transfer_state(src, dst):
+    """
+    Reset dst, then give it the simulator state of src where the env allows it.
+    Returns (obs, info) from the reset, and whether the state was transferred.
+    """
+    reset = dst.reset()
+    state = getattr(src.unwrapped, 'state', None)
+    if state is None or not hasattr(dst.unwrapped, 'state'):
+        return reset, False
+    dst.unwrapped.state = copy.deepcopy(state)
+    src_limit, dst_limit = find_time_limit(src), find_time_limit(dst)
+    if src_limit is not None and dst_limit is not None:
+        dst_limit._elapsed_steps = src_limit._elapsed_steps
+    return reset, True
+
+
+def find_time_limit(env):
+    while isinstance(env, gym.Wrapper):
+        if isinstance(env, gym.wrappers.TimeLimit):
+            return env
+        env = env.env
+    return None
+
+
+class EnvCache:
+    def __init__(self, max_idle=4):
+        self.max_idle = max_idle
+        self.envs = collections.OrderedDict()     # key -> env, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, name, render_mode=None, kwargs=None):
+        key = env_key(name, render_mode, kwargs)
+        env = self.envs.get(key)
+        if env is None:
+            self.misses += 1
+            env = gym.make(name, render_mode=render_mode, **(kwargs or {}))
+            self.envs[key] = env
+        else:
+            self.hits += 1
+        self.envs.move_to_end(key)
+        self.evict()
+        return env
+
+    def switch(self, env, name, render_mode=None, kwargs=None):
+        """
+        The instance for (name, render_mode, kwargs), continuing from env's state where possible.
+        Returns the instance, the (obs, info) of its reset, and whether the state was transferred.
+        """
+        new_env = self.get(name, render_mode, kwargs)
+        if new_env is env:
+            return env, None, True
+        reset, transferred = transfer_state(env, new_env) if env is not None else (new_env.reset(), False)
+        return new_env, reset, transferred
+
+    def evict(self):
+        # The most recently used instance is in use and never evicted
+        while len(self.envs) > self.max_idle + 1:
+            key, env = self.envs.popitem(last=False)
+            self.evictions += 1
+            env.close()
+
+    def close(self, name=None):
+        for key in [k for k in self.envs if name is None or k[0] == name]:
+            self.envs.pop(key).close()
+
+    def stats(self):
+        return {'instances': len(self.envs), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
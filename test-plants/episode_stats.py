@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Dynamic Object Language Labs Inc.
+#
+# This software is licensed under the terms of the
+# Apache License, Version 2.0 which can be found in
+# the file LICENSE at the root of this distribution.
+
+import numpy as np
+
+'''
+Rolling per-episode statistics kept by the plant
+
+EpisodeStats accumulates the return and length of the running episode
+from the steps the plant takes, and keeps the last 'window' finished
+episodes in NumPy ring buffers.  summary() is a small dict of moving
+averages and percentiles, published on a low rate topic so that
+dashboards need not follow the step stream.
+'''
+
+
+def succeeded(goal_position, state, reward, done):
+    # As GYMinterface/goal-achieved-MountainCar-V0 for envs with a goal position, else goal-achieved-generic
+    if goal_position is not None:
+        return bool(state[0] > goal_position)
+    return bool(done and reward >= 0)
+
+
+class EpisodeStats:
+    def __init__(self, window=100):
+        self.window = window
+        self.returns = np.zeros(window, dtype=np.float64)
+        self.lengths = np.zeros(window, dtype=np.int64)
+        self.successes = np.zeros(window, dtype=np.uint8)
+        self.episodes = 0           # finished episodes, the next one goes in slot episodes % window
+        self.episode_return = 0.0
+        self.episode_length = 0
+
+    def add_step(self, reward):
+        self.episode_return += reward
+        self.episode_length += 1
+
+    def end_episode(self, success):
+        """
+        Close the running episode, returns False when it had no steps and was not counted.
+        """
+        if self.episode_length == 0:
+            return False
+        k = self.episodes % self.window
+        self.returns[k] = self.episode_return
+        self.lengths[k] = self.episode_length
+        self.successes[k] = success
+        self.episodes += 1
+        self.episode_return = 0.0
+        self.episode_length = 0
+        return True
+
+    def summary(self):
+        n = min(self.episodes, self.window)
+        if n == 0:
+            return {'episodes': 0}
+        returns = self.returns[:n]
+        last = (self.episodes - 1) % self.window
+        p10, p50, p90 = np.percentile(returns, [10, 50, 90])
+        return {'episodes': self.episodes,
+                'window': int(n),
+                'mean-return': float(returns.mean()),
+                'std-return': float(returns.std()),
+                'return-p10': float(p10),
+                'return-p50': float(p50),
+                'return-p90': float(p90),
+                'mean-length': float(self.lengths[:n].mean()),
+                'success-rate': float(self.successes[:n].mean()),
+                'last-return': float(self.returns[last]),
+                'last-length': int(self.lengths[last]),
+                'last-success': bool(self.successes[last])}
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Dynamic Object Language Labs Inc.
+#
+# This software is licensed under the terms of the
+# Apache License, Version 2.0 which can be found in
+# the file LICENSE at the root of this distribution.
+
+import struct
+import numpy as np
+
+'''
+Compact binary observation frames
+
+An opt-in alternative to the per-field JSON observations for the hot
+step path.  A frame is a fixed little-endian header followed by packed
+arrays:
+
+    header   magic 'DMRF', version, kind, dtype size, num-obs, num-steps,
+             sequence number, timestamp (millis)
+    states   num-steps x num-obs values of the frame dtype
+    rewards  num-steps values of the frame dtype
+    flags    num-steps uint8, bit 0 = done (terminated), bit 1 = truncated
+
+The schema describing the layout is sent once, as a JSON observation,
+when the environment is made.  Frames have no limit on the number of
+state variables.
+'''
+
+MAGIC = b'DMRF'
+VERSION = 2         # 2: num-steps widened to 32 bits, a perform-actions may exceed 65535 steps
+HEADER = struct.Struct('<4sBBBxHxxIIxxxxd')    # 32 bytes, so the arrays after it stay aligned
+
+# Frame kinds
+KIND_STATE = 0      # reset, no reward
+KIND_STEP = 1       # one perform-action
+KIND_STEPS = 2      # a perform-actions sequence
+
+FLAG_DONE = 1
+FLAG_TRUNCATED = 2
+
+DTYPES = {'float32': np.float32, 'float64': np.float64}
+
+
+def make_flags(done, truncated):
+    return (FLAG_DONE if done else 0) | (FLAG_TRUNCATED if truncated else 0)
+
+
+class FrameEncoder:
+    def __init__(self, dtype_name, num_obs):
+        if dtype_name not in DTYPES:
+            raise ValueError('Unknown frame dtype ' + str(dtype_name))
+        self.dtype_name = dtype_name
+        self.dtype = np.dtype(DTYPES[dtype_name])
+        self.num_obs = num_obs
+        self.seq = 0
+
+    def schema(self, routing_key):
+        return {'version': VERSION,
+                'routing-key': routing_key,
+                'byte-order': 'little',
+                'header': ['magic', 'version', 'kind', 'dtype-size', 'num-obs', 'num-steps', 'seq', 'timestamp'],
+                'header-format': HEADER.format,
+                'header-size': HEADER.size,
+                'dtype': self.dtype_name,
+                'num-obs': self.num_obs,
+                'kinds': {'state': KIND_STATE, 'step': KIND_STEP, 'steps': KIND_STEPS},
+                'flags': {'done': FLAG_DONE, 'truncated': FLAG_TRUNCATED}}
+
+    def encode(self, kind, states, rewards, flags, timestamp):
+        states = np.asarray(states, dtype=self.dtype).reshape(-1, self.num_obs)
+        num_steps = states.shape[0]
+        self.seq = (self.seq + 1) & 0xffffffff
+        header = HEADER.pack(MAGIC, VERSION, kind, self.dtype.itemsize, self.num_obs, num_steps, self.seq, timestamp)
+        return b''.join([header,
+                         states.tobytes(),
+                         np.asarray(rewards, dtype=self.dtype).tobytes(),
+                         np.asarray(flags, dtype=np.uint8).tobytes()])
+
+    def encode_state(self, state, timestamp):
+        return self.encode(KIND_STATE, [state], [0.0], [0], timestamp)
+
+    def encode_step(self, state, reward, done, truncated, timestamp):
+        return self.encode(KIND_STEP, [state], [reward], [make_flags(done, truncated)], timestamp)
+
+    def encode_steps(self, states, rewards, dones, truncateds, timestamp):
+        flags = [make_flags(d, t) for d, t in zip(dones, truncateds)]
+        return self.encode(KIND_STEPS, states, rewards, flags, timestamp)
+
+
+def decode(data):
+    """
+    Decode a frame into a dict with numpy arrays for states, rewards and flags.
+    """
+    magic, version, kind, dtype_size, num_obs, num_steps, seq, timestamp = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a version ' + str(VERSION) + ' observation frame')
+    dtype = np.float32 if dtype_size == 4 else np.float64
+    offset = HEADER.size
+    states = np.frombuffer(data, dtype=dtype, count=num_steps * num_obs, offset=offset).reshape(num_steps, num_obs)
+    offset += states.nbytes
+    rewards = np.frombuffer(data, dtype=dtype, count=num_steps, offset=offset)
+    offset += rewards.nbytes
+    flags = np.frombuffer(data, dtype=np.uint8, count=num_steps, offset=offset)
+    return {'kind': kind, 'seq': seq, 'timestamp': timestamp,
+            'states': states, 'rewards': rewards, 'flags': flags,
+            'dones': (flags & FLAG_DONE) != 0, 'truncateds': (flags & FLAG_TRUNCATED) != 0}
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Dynamic Object Language Labs Inc.
+#
+# This software is licensed under the terms of the
+# Apache License, Version 2.0 which can be found in
+# the file LICENSE at the root of this distribution.
+
+import collections
+import concurrent.futures
+import hashlib
+import json
+import threading
+import time
+
+'''
+Cached, non-blocking GPT advice for the gym plant
+
+Completions are keyed by a hash of the model and the full message list
+(system messages and prompt), kept in an in-memory LRU and optionally in
+an sqlite file so that repeated advice survives plant restarts.  Entries
+expire after ttl seconds.  GptAdvisor runs completions that miss the
+cache in a thread pool and calls back with the result, so the plant keeps
+serving other commands while a completion is pending.
+
+A completion backend is any function (model, messages) -> result or None;
+stub_completion answers offline for tests and benchmarks.
+'''
+
+
+def cache_key(model, messages):
+    text = json.dumps([model, messages], sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def stub_completion(model, messages):
+    # Offline stand-in: echo the advice back in the expected json form
+    return {'precondition': 'always', 'advice': messages[-1]['content'], 'model': model, 'stub': True}
+
+
+class ResponseCache:
+    def __init__(self, path=None, max_entries=256, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl              # seconds, None for no expiry
+        self.lock = threading.Lock()
+        self.memory = collections.OrderedDict()     # key -> (created, value), least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        if path is not None:
+            import sqlite3          # Only for a persistent cache
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS responses '
+                            '(key TEXT PRIMARY KEY, value TEXT, created REAL, used REAL)')
+            self.db.commit()
+
+    def expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key):
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is None and self.db is not None:
+                row = self.db.execute('SELECT created, value FROM responses WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    entry = (row[0], json.loads(row[1]))
+            if entry is None or self.expired(entry[0]):
+                self.misses += 1
+                if entry is not None:
+                    self.remove(key)
+                return None
+            self.hits += 1
+            self.memory[key] = entry
+            self.memory.move_to_end(key)
+            self.trim_memory()
+            if self.db is not None:
+                self.db.execute('UPDATE responses SET used = ? WHERE key = ?', (time.time(), key))
+                self.db.commit()
+            return entry[1]
+
+    def put(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.memory[key] = (now, value)
+            self.memory.move_to_end(key)
+            self.trim_memory()
+            if self.db is not None:
+                self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                                (key, json.dumps(value), now, now))
+                self.evict_disk()
+                self.db.commit()
+
+    def remove(self, key):
+        # Called with lock held
+        self.memory.pop(key, None)
+        if self.db is not None:
+            self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.db.commit()
+
+    def trim_memory(self):
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def evict_disk(self):
+        # Drop expired entries, then the least recently used beyond max_entries
+        if self.ttl is not None:
+            self.db.execute('DELETE FROM responses WHERE created < ?', (time.time() - self.ttl,))
+        self.db.execute('DELETE FROM responses WHERE key NOT IN '
+                        '(SELECT key FROM responses ORDER BY used DESC LIMIT ?)', (self.max_entries,))
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+class GptAdvisor:
+    def __init__(self, completion, cache=None, max_workers=2):
+        self.completion = completion
+        self.cache = cache if cache is not None else ResponseCache()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.in_flight = {}         # key -> list of callbacks waiting for the same completion
+
+    def ask(self, model, messages, on_result):
+        """
+        Call on_result(result) with the completion, now if cached, otherwise from a pool thread.
+        Identical requests that are already pending share one completion.
+        """
+        key = cache_key(model, messages)
+        result = self.cache.get(key)
+        if result is not None:
+            on_result(result)
+            return
+        with self.lock:
+            if key in self.in_flight:
+                self.in_flight[key].append(on_result)
+                return
+            self.in_flight[key] = [on_result]
+        self.executor.submit(self.complete, key, model, messages)
+
+    def complete(self, key, model, messages):
+        result = None
+        try:
+            result = self.completion(model, messages)
+        except Exception as e:
+            print('GPT completion failed', e.__class__.__name__ + ": " + str(e))
+        if result is not None:
+            self.cache.put(key, result)
+        with self.lock:
+            callbacks = self.in_flight.pop(key, [])
+        for on_result in callbacks:
+            on_result(result)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+        self.cache.close()
@@ -6,16 +6,16 @@
 # Apache License, Version 2.0 which can be found in
 # the file LICENSE at the root of this distribution.
 
+import time
+# Startup timing, see report_startup
+startup_started = time.perf_counter()
 import argparse
 import os
 import sys
-import time
-import openai
+import threading
 from pprint import pprint
 import gymnasium as gym
-from openai import OpenAI
 import numpy as np
-import matplotlib.pyplot as plt
 import json
 #from dotenv import load_dotenv
 
@@ -33,6 +33,21 @@ except Exception as exception:
     print(exception, False)
     print(exception.__class__.__name__ + ": " + exception.message)
 
+from vec_envs import VecEnvPool
+import frames
+import gpt_cache
+import qlearning
+import env_cache
+import metrics
+import trajectory
+import step_clock
+import episode_stats
+
+# Imported where first used: openai by openai_completion, aio_plant and asyncio for --asyncio,
+# shm_frames for --shm-frames, concurrent.futures and multiprocessing by process_pool
+
+import_seconds = time.perf_counter() - startup_started
+
 # Globals
 rmq = None
 
@@ -70,40 +85,101 @@ class Rmq:
     done = False
 
     gpt_says = None
+    gpt_model = "gpt-4-1106-preview"
+
+    frames = None               # binary frame encoder, None for json observations
+    frame_routing_key = 'gym.frames'
+    qtable_routing_key = 'gym.qtable'
+
+    plant_class = plant.Plant
+
+    record_dir = None           # directory for trajectory recordings, None for no recording
+    recorder = None
+
+    step_rate = 0               # default start-clock rate in Hz
+    clock = None                # step_clock.StepClock while the plant steps at a fixed rate
+    latched_action = 0
+    clock_hold = False          # the episode ended on a tick, wait for reset
+
+    episode_stats_window = 0    # episodes in the rolling episode stats, 0 for none
+    episode_stats_interval = 0  # seconds between episode stats summaries, 0 for one per finished episode
+    episode_stats_timer = False
+
+    eval_workers = os.cpu_count() or 1      # processes for evaluate-policy and train-episodes
+    eval_pool = None
 
-    def __init__(self, plantid, exchange, host, port):
-        self.plant = plant.Plant(plantid, exchange, host, port)
+    shm_frames = None           # shared memory ring for pixel observations and rgb_array renders
+    pixels = False              # the env observes images, published through shm_frames
+
+    def __init__(self, plantid, exchange, host, port, encoding='json', **plant_options):
+        self.plant = self.plant_class(plantid, exchange, host, port, **plant_options)
+        self.encoding = encoding    # default observation encoding when make_env does not ask for one
+        # Completions are cached and run off the consumer thread, see gpt_cache
+        self.advisor = gpt_cache.GptAdvisor(self.openai_completion)
+        # Instances are reused across render mode switches instead of being rebuilt
+        self.envs = env_cache.EnvCache()
+        self.episode_stats = {}     # plant-id -> episode_stats.EpisodeStats
+        self.episode_stats_published = {}   # plant-id -> episodes at the last summary
+        self.plant.metrics.describe('gym_step_seconds', 'time in env.step, or stepping the whole pool')
+        self.plant.metrics.describe('gym_tick_late_seconds', 'how late fixed rate ticks ran')
         # self.plant.connection.add_callback_threadsafe(self.rmq_call_back) # Not needed
         self.done = False
         self.last_rmq_call_back = time.time()
 
     envname = None
+    env_kwargs = None           # extra gym.make arguments from make_env
     humanmode = False
     rendermode = -1
 
     def make_env(self, msg):
         self.plant.started(msg)
-        self.envname, self.rendermode = msg['args']
-        print('gym make: ', self.envname, 'render-mode = ', self.rendermode)
-        if self.rendermode == -1:
-            self.env=gym.make(self.envname, render_mode='human')
-        else:
-            self.env=gym.make(self.envname)
+        # args are [envname, rendermode] with an optional observation encoding: json, float32 or float64,
+        # and an optional map of gym.make arguments
+        envname, rendermode = msg['args'][:2]
+        encoding = msg['args'][2] if len(msg['args']) > 2 else self.encoding
+        env_kwargs = msg['args'][3] if len(msg['args']) > 3 else None
+        if not self.valid_encoding(encoding):
+            self.plant.failed(msg, "Unknown observation encoding " + str(encoding))
+            return
+        print('gym make: ', envname, 'render-mode = ', rendermode)
+        env = self.envs.get(envname, 'human' if rendermode == -1 else None, env_kwargs)
+        # Validated before the plant's state changes, so a failed make_env leaves the last env in place
+        pixels = len(env.observation_space.shape) > 1
+        if pixels and self.shm_frames is None:
+            self.plant.failed(msg, "Pixel observations of " + envname + " need --shm-frames")
+            return
+        if pixels and encoding != 'json':
+            self.plant.failed(msg, "Pixel observations are published as shared memory frames, not " + encoding)
+            return
+        self.envname, self.rendermode, self.env_kwargs = envname, rendermode, env_kwargs
+        self.env = env
+        self.humanmode = False
+        self.pixels = pixels
+        self.start_recording()
         self.plant.finished(msg)
         #print('make_env, env=', self.env)
+        self.plant.observation_keyframe("gym")     # The new env may have fewer fields than the last one
         self.publish_data_obs_rmq()
+        self.frames = self.publish_frame_schema_rmq(encoding, "gym", self.frame_routing_key)
 
     def reset(self, msg):
         self.plant.started(msg)
         # no args for reset -- alt, = msg['args']
         if not self.env==None:
             if (self.rendermode > 0) and self.humanmode:
-                self.env.close()             # Close the rendering
-                self.env = gym.make(self.envname) # Make a new envinonment without rendering
+                # Back to the headless instance, the rendering one stays open for the next render
+                self.env = self.envs.get(self.envname, None, self.env_kwargs)
                 self.humanmode = False
             self.gym_new_state=self.env.reset()
+            self.clock_hold = False
+            self.track_reset("gym")
+            if self.recorder is not None:
+                self.recorder.begin_episode(self.gym_new_state[0])
             #print('reset') #, alt
             self.publish_state_obs_rmq()
+            # In delta mode the episode's first step goes out whole, done included, as a learner
+            # may forget the last episode's fields on reset
+            self.plant.observation_keyframe("gym")
         self.plant.finished(msg)
         #print('done reset')
 
@@ -111,61 +187,395 @@ class Rmq:
         self.plant.started(msg)
         # no args for reset -- alt, = msg['args']
         if not self.env==None:
-            self.env.close()
+            self.stop_clock_ticks()
+            self.envs.close(self.envname)
             self.env=None
-            self.publish_state_obs_rmq()
+            self.stop_recording()
+            # No state observation, there is no env left to observe
         self.plant.finished(msg)
         #print('done close')
 
     def render(self, msg):
         self.plant.started(msg)
-        # no args for render -- alt, = msg['args']
+        # no args for render, or ['rgb_array'] for a frame in shared memory
+        if msg.get('args') and msg['args'][0] == 'rgb_array':
+            self.render_rgb_array(msg)
+            return
         if (self.rendermode > 0) and (self.humanmode == False):
-            self.env.close() # close the existing environment
-            self.env=gym.make(self.envname, render_mode='human')
+            # Continue the episode in the rendering instance where the env allows it
+            self.env, reset, transferred = self.envs.switch(self.env, self.envname, 'human', self.env_kwargs)
             self.humanmode = True
-            self.gym_new_state=self.env.reset()
+            if not transferred:
+                self.gym_new_state = reset
         self.env.render()
         #print('render') #, alt
         self.plant.finished(msg)
         #print('done render')
 
+    def render_rgb_array(self, msg):
+        if self.shm_frames is None:
+            self.plant.failed(msg, "rgb_array rendering needs --shm-frames")
+            return
+        if self.env.render_mode != 'rgb_array':
+            # Carry on in an rgb_array instance, which only renders when asked to
+            self.env, reset, transferred = self.envs.switch(self.env, self.envname, 'rgb_array', self.env_kwargs)
+            self.humanmode = False
+            if not transferred:
+                self.gym_new_state = reset
+        descriptor = self.shm_frames.write(self.env.render())
+        self.plant.observations(None, [self.plant.make_observation('render-frame', descriptor)],
+                                copy_observations=False, plantid="gym")
+        self.plant.finished(msg)
+
     def perform_action(self, msg):
         action_name, = msg['args']
         action_number = int(action_name)
+        if self.clock is not None:
+            self.latch_action(msg, action_number)
+            return
         if self.env.action_space.n >= action_number >= 0:
-            self.gym_new_state, self.gym_reward, self.gym_done, gym_truncated, gym_info  = self.env.step(action_number)
+            self.gym_new_state, self.gym_reward, self.gym_done, self.gym_truncated, self.gym_info  = self.step_env(action_number)
             self.gym_goal_position = 0 #self.env.goal_position
-            self.publish_step_obs_rmq()
+            if self.recorder is not None:
+                self.recorder.record(action_number, self.gym_reward, self.gym_new_state, self.gym_done, self.gym_truncated)
+            self.track_env_step()
+            self.publish_step_obs_rmq(msg)
         else:
             print('Bad action specified:', action_name)
-        self.plant.finished(msg)
+            self.plant.finished(msg)
         #print('done perform_action')
 
-    def gpt_ask(self, msg):
-        prompt, = msg['args']
-        self.gpt_says = self.get_gpt4_json_response(prompt)
-        if not (self.gpt_says==None):
-            print(self.gpt_says) # +++ we need to publish this back to the caller
+    # Fixed rate stepping.  While the clock runs, perform-action only latches the action
+    # and every tick steps the env with the latest one and publishes the step.
+
+    def start_clock(self, msg):
+        # args are [] for the --step-rate rate, or [rate] or [rate, initial action]
+        self.plant.started(msg)
+        args = msg['args']
+        rate = float(args[0]) if args else self.step_rate
+        if self.env is None:
+            self.plant.failed(msg, "start-clock needs a gym env made by make_env")
+            return
+        if rate <= 0:
+            self.plant.failed(msg, "start-clock needs a rate in Hz, or --step-rate")
+            return
+        self.stop_clock_ticks()
+        self.latched_action = int(args[1]) if len(args) > 1 else 0
+        self.clock = step_clock.StepClock(rate, self.plant.call_later, self.clock_tick)
+        self.clock.start()
+        self.plant.finished(msg)
+
+    def stop_clock(self, msg):
+        self.plant.started(msg)
+        if self.clock is None:
+            self.plant.failed(msg, "The clock is not running")
+            return
+        self.stop_clock_ticks()
+        self.plant.finished(msg)
+
+    def stop_clock_ticks(self):
+        if self.clock is not None:
+            self.clock.stop()
+            self.publish_clock_stats()
+            self.clock = None
+
+    def latch_action(self, msg, action_number):
+        if self.env.action_space.n > action_number >= 0:
+            self.latched_action = action_number
         else:
-            print('GPT did not find anything to say in response to ', prompt)
-        self.publish_gpt_obs_rmq()
+            print('Bad action specified:', action_number)
         self.plant.finished(msg)
-        #print('done ask_gpt action')
 
-    def publish_gpt_obs_rmq(self):
-        obs=[self.plant.make_observation('gpt-response',  self.gpt_says)] if self.gpt_says else []
+    def clock_tick(self, tick, late):
+        self.plant.metrics.observe('gym_tick_late_seconds', abs(late))
+        if self.clock_hold:
+            return                  # Stepping a finished episode is undefined, wait for reset
+        self.gym_new_state, self.gym_reward, self.gym_done, self.gym_truncated, self.gym_info = \
+            self.step_env(self.latched_action)
+        self.clock_hold = self.gym_done or self.gym_truncated
+        if self.recorder is not None:
+            self.recorder.record(self.latched_action, self.gym_reward, self.gym_new_state, self.gym_done, self.gym_truncated)
+        self.track_env_step()
+        if self.frames is not None:
+            self.publish_step_obs_rmq()
+            return
+        gym_tick_observations = self.make_step_observation() + [
+            self.plant.make_observation('tick', tick),
+            self.plant.make_observation('tick-late-ms', late * 1000.0)]
+        self.plant.observations(None, gym_tick_observations, copy_observations=False, plantid="gym")
+
+    def publish_clock_stats(self):
+        stats = self.clock.stats()
+        print('clock', stats)
+        self.plant.observations(None, [self.plant.make_observation('clock-stats', stats)],
+                                copy_observations=False, plantid="gym")
+
+    # Rolling episode stats, published on <plant-id>.episode-stats
+
+    def track_env_step(self):
+        goal_position = getattr(self.env.unwrapped, 'goal_position', None) if self.env is not None else None
+        self.track_step("gym", self.gym_reward, self.gym_done, self.gym_truncated, self.gym_new_state, goal_position)
+
+    def track_step(self, pid, reward, done, truncated, state, goal_position=None):
+        if self.episode_stats_window <= 0:
+            return
+        stats = self.episode_stats.get(pid)
+        if stats is None:
+            stats = self.episode_stats[pid] = episode_stats.EpisodeStats(self.episode_stats_window)
+        if self.episode_stats_interval > 0 and not self.episode_stats_timer:
+            # Started here so that the timer runs on the connection thread, whichever plant that is
+            self.episode_stats_timer = True
+            self.plant.call_later(self.episode_stats_interval, self.episode_stats_due)
+        stats.add_step(float(reward))
+        if done or truncated:
+            stats.end_episode(episode_stats.succeeded(goal_position, state, reward, done))
+            if self.episode_stats_interval <= 0:
+                self.publish_episode_stats(pid)
+
+    def track_reset(self, pid):
+        # A reset before the episode finished ends it unsuccessfully, as the learner gave up at max-steps
+        stats = self.episode_stats.get(pid)
+        if stats is not None and stats.end_episode(False) and self.episode_stats_interval <= 0:
+            self.publish_episode_stats(pid)
+
+    def episode_stats_due(self):
+        for pid, stats in self.episode_stats.items():
+            if stats.episodes != self.episode_stats_published.get(pid):
+                self.publish_episode_stats(pid)
+        self.plant.call_later(self.episode_stats_interval, self.episode_stats_due)
+
+    def publish_episode_stats(self, pid):
+        stats = self.episode_stats[pid]
+        self.episode_stats_published[pid] = stats.episodes
+        self.plant.observations(None, [self.plant.make_observation('episode-stats', stats.summary())],
+                                copy_observations=False, plantid=pid, routing_key=pid + '.episode-stats')
+
+    def start_recording(self):
+        # Each make_env starts a new recording when --record is given
+        self.stop_recording()
+        if self.record_dir is not None and self.pixels:
+            print('Not recording', self.envname, ', pixel observations are not supported by the recorder')
+        elif self.record_dir is not None:
+            path = os.path.join(self.record_dir, self.envname + '-' + str(int(plant.get_time_millis())))
+            self.recorder = trajectory.TrajectoryRecorder(path, self.envname,
+                                                          self.env.observation_space, self.env.action_space)
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def step_env(self, action_number):
+        t0 = time.perf_counter()
+        result = self.env.step(action_number)
+        self.plant.metrics.observe('gym_step_seconds', time.perf_counter() - t0, env=self.envname)
+        return result
+
+    def perform_actions(self, msg):
+        # args are either [[action, action, ...]] or [action, repeat-count]
+        if self.clock is not None:
+            self.plant.failed(msg, "perform-actions is not supported while the clock runs")
+            return
+        if self.pixels:
+            self.plant.failed(msg, "perform-actions is not supported for pixel observations")
+            return
+        args = msg['args']
+        if len(args) == 2:
+            action_names = [args[0]] * int(args[1])
+        else:
+            action_names, = args
+        states = []
+        rewards = []
+        dones = []
+        truncateds = []
+        for action_name in action_names:
+            action_number = int(action_name)
+            if not (self.env.action_space.n > action_number >= 0):
+                print('Bad action specified:', action_name)
+                break
+            self.gym_new_state, self.gym_reward, self.gym_done, self.gym_truncated, self.gym_info = self.step_env(action_number)
+            if self.recorder is not None:
+                self.recorder.record(action_number, self.gym_reward, self.gym_new_state, self.gym_done, self.gym_truncated)
+            self.track_env_step()
+            states.append([float(x) for x in self.gym_new_state])
+            rewards.append(float(self.gym_reward))
+            dones.append(bool(self.gym_done))
+            truncateds.append(bool(self.gym_truncated))
+            if self.gym_done or self.gym_truncated:
+                break                   # Stop early, the episode is over
+        self.gym_goal_position = 0
+        if states:
+            self.publish_steps_obs_rmq(states, rewards, dones, truncateds, msg)
+        else:
+            self.plant.finished(msg)
+
+    def train_episodes(self, msg):
+        # args are [params], a map of the learner's hyperparameters, see qlearning.
+        # Training runs in a pool process on an env of its own, the plant and its env keep serving.
+        self.plant.started(msg)
+        if self.env is None:
+            self.plant.failed(msg, "train-episodes needs make_env first")
+            return
+        if self.pixels:
+            self.plant.failed(msg, "train-episodes needs Box observations, not pixels")
+            return
+        try:
+            params, = msg['args']
+            qlearning.check_training_params(params)
+            discretization = int(params['discretization'])
+            # The learner may narrow unbounded observation spaces, as with CartPole's velocities
+            low = np.asarray(params.get('low', self.env.observation_space.low), dtype=np.float64)
+            high = np.asarray(params.get('high', self.env.observation_space.high), dtype=np.float64)
+            win_size = (high - low) / discretization
+            shape = [discretization] * len(low) + [int(self.env.action_space.n)]
+            rng = np.random.default_rng(params.get('seed'))
+            q = qlearning.make_q_table(params, shape, rng)
+        except (KeyError, ValueError, TypeError) as e:
+            self.plant.failed(msg, "Bad train-episodes params: " + e.__class__.__name__ + ": " + str(e))
+            return
+        description = {'id': msg['id'], 'plant-id': self.plant.get_plantId(msg), 'env': self.envname,
+                       'start-episode': int(params.get('start-episode', 0))}
+        t0 = time.time()
+
+        # Called from the pool's thread when training completes
+        def respond(future):
+            try:
+                q, rewards, steps, succeeded, epsilons = future.result()
+            except Exception as e:
+                self.plant.failed(msg, "train-episodes failed " + e.__class__.__name__ + ": " + str(e))
+                return
+            description['seconds'] = time.time() - t0
+            self.plant.binary_publish(self.qtable_routing_key,
+                                      qlearning.encode_result(description, q, rewards, steps, succeeded, epsilons))
+            self.plant.finished(msg)
+        self.process_pool().submit(qlearning.train_in_process, self.envname, self.env_kwargs, q, low, win_size,
+                                   params, rng).add_done_callback(respond)
+
+    def evaluate_policy(self, msg):
+        # args are [params]: the Q-table as in train-episodes, its discretization, seeds and
+        # optionally max-steps and goal-positions.  The greedy policy runs once per seed and goal position.
+        self.plant.started(msg)
+        if self.env is None:
+            self.plant.failed(msg, "evaluate-policy needs make_env first")
+            return
+        if self.pixels:
+            self.plant.failed(msg, "evaluate-policy needs Box observations, not pixels")
+            return
+        # All params are checked here, a bad one must fail the command rather than the consumer
+        try:
+            params, = msg['args']
+            discretization = int(params['discretization'])
+            if discretization < 1:
+                raise ValueError('discretization must be at least 1')
+            low = np.asarray(params.get('low', self.env.observation_space.low), dtype=np.float64)
+            high = np.asarray(params.get('high', self.env.observation_space.high), dtype=np.float64)
+            win_size = (high - low) / discretization
+            shape = [discretization] * len(low) + [int(self.env.action_space.n)]
+            q = qlearning.decode_q_table(params['q-table'], shape)
+            seeds = [int(seed) for seed in params['seeds']]
+            max_steps = int(params.get('max-steps') or self.env.spec.max_episode_steps or 10000)
+            goal_positions = list(params.get('goal-positions') or [None])
+        except (KeyError, ValueError, TypeError) as e:
+            self.plant.failed(msg, "Bad evaluate-policy params: " + e.__class__.__name__ + ": " + str(e))
+            return
+        if not seeds:
+            self.plant.failed(msg, "evaluate-policy needs at least one seed")
+            return
+        chunk = max(1, -(-len(seeds) * len(goal_positions) // self.eval_workers))
+        jobs = []
+        for goal_position in goal_positions:
+            for k in range(0, len(seeds), chunk):
+                jobs.append((goal_position, self.process_pool().submit(
+                    qlearning.evaluate_seeds, self.envname, self.env_kwargs, q, low, win_size,
+                    discretization, max_steps, seeds[k:k + chunk], goal_position)))
+        t0 = time.time()
+
+        # Called from the pool's thread as the last chunk completes, the consumer thread keeps serving
+        lock = threading.Lock()
+        pending = [len(jobs)]
+
+        def respond(future):
+            with lock:
+                pending[0] -= 1
+                if pending[0] > 0:
+                    return
+            try:
+                results = {}
+                for goal_position, job in jobs:
+                    results.setdefault(goal_position, []).extend(job.result())
+            except Exception as e:
+                self.plant.failed(msg, "evaluate-policy failed " + e.__class__.__name__ + ": " + str(e))
+                return
+            evaluation = {'env': self.envname, 'seconds': time.time() - t0,
+                          'goal-positions': [dict(qlearning.summarize_evaluation(r), **{'goal-position': g})
+                                             for g, r in results.items()]}
+            self.plant.observations(None, [self.plant.make_observation('policy-evaluation', evaluation)],
+                                    copy_observations=False, plantid=self.plant.get_plantId(msg))
+            self.plant.finished(msg)
+        for goal_position, job in jobs:
+            job.add_done_callback(respond)
+
+    def process_pool(self):
+        if self.eval_pool is None:
+            import concurrent.futures
+            import multiprocessing
+            # spawn, not fork: the children must not inherit the RMQ connection and plant threads
+            self.eval_pool = concurrent.futures.ProcessPoolExecutor(self.eval_workers,
+                                                                    multiprocessing.get_context('spawn'))
+        return self.eval_pool
+
+    def gpt_ask(self, msg):
+        prompt, = msg['args']
+
+        # Called when the completion is ready, possibly from an advisor thread
+        def respond(gpt_says):
+            self.gpt_says = gpt_says
+            if not (gpt_says==None):
+                print(gpt_says)
+            else:
+                print('GPT did not find anything to say in response to ', prompt)
+            self.publish_gpt_obs_rmq(gpt_says)
+            self.plant.finished(msg)
+            #print('done ask_gpt action')
+
+        self.advisor.ask(self.gpt_model, self.gpt_messages(prompt), respond)
+
+    def publish_gpt_obs_rmq(self, gpt_says):
+        obs=[self.plant.make_observation('gpt-response',  gpt_says)] if gpt_says else []
         self.plant.observations(None, obs, copy_observations=False, plantid="gym")
 
     def publish_data_obs_rmq(self):
-        gym_data_observations = self.make_gym_data_observation()
+        gym_data_observations = self.make_gym_data_observation(self.env.observation_space, self.env.action_space)
         pprint(gym_data_observations)
         self.plant.observations(None, gym_data_observations, copy_observations=False, plantid="gym")
 
-    def make_gym_data_observation(self):
-        self.obs_high = self.env.observation_space.high
-        self.obs_low = self.env.observation_space.low
-        self.num_acts = self.env.action_space.n
+    def valid_encoding(self, encoding):
+        return encoding == 'json' or encoding in frames.DTYPES
+
+    def publish_frame_schema_rmq(self, encoding, plantid, routing_key):
+        # Binary frames are opt-in; the schema is published once and the encoder returned for the step path.
+        if encoding == 'json':
+            return None
+        encoder = frames.FrameEncoder(encoding, int(self.num_obs))
+        schema = encoder.schema(routing_key)
+        schema['high'] = [float(x) for x in self.obs_high]
+        schema['low'] = [float(x) for x in self.obs_low]
+        obs = [self.plant.make_observation('frame-schema', schema)]
+        self.plant.observations(None, obs, copy_observations=False, plantid=plantid)
+        return encoder
+
+    def make_gym_data_observation(self, observation_space, action_space):
+        if len(observation_space.shape) > 1:
+            # Images have no per-variable fields, each state is a shared memory frame
+            self.num_acts = action_space.n
+            self.num_obs = 0
+            return [self.plant.make_observation('numacts', int(self.num_acts)),
+                    self.plant.make_observation('numobs', 0),
+                    self.plant.make_observation('obs-shape', [int(x) for x in observation_space.shape]),
+                    self.plant.make_observation('obs-dtype', np.dtype(observation_space.dtype).str)]
+        self.obs_high = observation_space.high
+        self.obs_low = observation_space.low
+        self.num_acts = action_space.n
         self.num_obs = len(self.obs_high)
 
         p1=[self.plant.make_observation('numacts', int(self.num_acts)),
@@ -180,10 +590,21 @@ class Rmq:
         p9=[self.plant.make_observation('low3',  float(self.obs_low[3]))]  if self.num_obs>3 else []
         return p1+p2+p3+p4+p5+p6+p7+p8+p9
 
-    def publish_step_obs_rmq(self):
+    def publish_step_obs_rmq(self, finished_msg=None):
+        # finished_msg is finished after the step is published, in the same message in delta mode
+        if self.frames is not None:
+            t0 = time.perf_counter()
+            frame = self.frames.encode_step(self.gym_new_state, self.gym_reward, self.gym_done, self.gym_truncated,
+                                            plant.get_time_millis())
+            self.plant.metrics.observe('plant_serialize_seconds', time.perf_counter() - t0, encoding='binary')
+            self.plant.binary_publish(self.frame_routing_key, frame)
+            if finished_msg is not None:
+                self.plant.finished(finished_msg)
+            return
         gym_step_observations = self.make_step_observation()
         #pprint(gym_step_observations)
-        self.plant.observations(None, gym_step_observations, copy_observations=False, plantid="gym")
+        self.plant.observations(None, gym_step_observations, copy_observations=False, plantid="gym",
+                                finished_msg=finished_msg)
 
     def make_step_observation(self):
         p1=[self.plant.make_observation('reward',  float(self.gym_reward))]
@@ -193,9 +614,33 @@ class Rmq:
         p5=[self.plant.make_observation('state3',  float(self.gym_new_state[3]))] if self.num_obs>3 else []
         p6=[self.plant.make_observation('done',          self.gym_done)]
         p7=[self.plant.make_observation('goal_position', self.gym_goal_position)]
-        return p1+p2+p3+p4+p5+p6+p7
+        p8=[self.plant.make_observation('frame', self.shm_frames.write(self.gym_new_state))] if self.pixels else []
+        return p1+p2+p3+p4+p5+p6+p7+p8
+
+    def publish_steps_obs_rmq(self, states, rewards, dones, truncateds, finished_msg=None):
+        if self.frames is not None:
+            t0 = time.perf_counter()
+            frame = self.frames.encode_steps(states, rewards, dones, truncateds, plant.get_time_millis())
+            self.plant.metrics.observe('plant_serialize_seconds', time.perf_counter() - t0, encoding='binary')
+            self.plant.binary_publish(self.frame_routing_key, frame)
+            if finished_msg is not None:
+                self.plant.finished(finished_msg)
+            return
+        # The last step is published as usual so that readers of the single step fields keep working
+        gym_steps_observations = self.make_step_observation() + [
+            self.plant.make_observation('steps',      len(states)),
+            self.plant.make_observation('states',     states),
+            self.plant.make_observation('rewards',    rewards),
+            self.plant.make_observation('dones',      dones),
+            self.plant.make_observation('truncateds', truncateds)]
+        self.plant.observations(None, gym_steps_observations, copy_observations=False, plantid="gym",
+                                finished_msg=finished_msg)
 
     def publish_state_obs_rmq(self):
+        if self.frames is not None:
+            self.plant.binary_publish(self.frame_routing_key,
+                                      self.frames.encode_state(self.gym_new_state[0], plant.get_time_millis()))
+            return
         gym_state_observations = self.make_state_observation()
         #pprint(gym_state_observations)
         self.plant.observations(None, gym_state_observations, copy_observations=False, plantid="gym")
@@ -205,7 +650,8 @@ class Rmq:
         p3=[self.plant.make_observation('state1',  float(self.gym_new_state[0][1]))] if self.num_obs>1 else []
         p4=[self.plant.make_observation('state2',  float(self.gym_new_state[0][2]))] if self.num_obs>2 else []
         p5=[self.plant.make_observation('state3',  float(self.gym_new_state[0][3]))] if self.num_obs>3 else []
-        return p2+p3+p4+p5
+        p6=[self.plant.make_observation('frame', self.shm_frames.write(self.gym_new_state[0]))] if self.pixels else []
+        return p2+p3+p4+p5+p6
 
 ############################################
 # OpenAI
@@ -216,7 +662,11 @@ class Rmq:
         print("WARNING: the OPENAI_API_KEY environment variable was not found")
 
     def get_gpt4_json_response(self, prompt):
-        our_messages=[{"role": "system",
+        # Blocking and uncached, gpt_ask goes through the advisor instead
+        return self.openai_completion(self.gpt_model, self.gpt_messages(prompt))
+
+    def gpt_messages(self, prompt):
+        return [{"role": "system",
                    "content": "You are a robot and to express your understanding of recommandations by summarizing them as in json form."},
                   {"role": "system",
                    "content": "You deliver your responses in json as follows { 'precondition': 'speed=high', 'avoid': 'actuation-changes', 'do': 'misdemeanor' }'"},
@@ -224,10 +674,13 @@ class Rmq:
                    "content" : "Example: when the speed is high. avoid changing direction { 'precondition': 'speed=high', 'avoid' : 'changing-direction'}"},
                   {"role": "user",
                    "content": "REspond to this advice: "+prompt}]
+
+    def openai_completion(self, model, our_messages):
+        import openai               # Slow to import and most plants never ask GPT
         openai.api_key = os.getenv("OPENAI_API_KEY")
 
         response = openai.chat.completions.create(
-            model="gpt-4-1106-preview",
+            model=model,
             messages=our_messages,
             response_format={"type": "json_object"})
         print("A total of "+str(response.usage.total_tokens)+" tokens used")
@@ -264,10 +717,22 @@ class Rmq:
             self.make_env(msg)
         elif fn_name == 'reset':
             self.reset(msg)
+        elif fn_name == 'close':
+            self.close(msg)
         elif fn_name == 'render':
             self.render(msg)
         elif fn_name == 'perform-action':
             self.perform_action(msg)
+        elif fn_name == 'perform-actions':
+            self.perform_actions(msg)
+        elif fn_name == 'train-episodes':
+            self.train_episodes(msg)
+        elif fn_name == 'evaluate-policy':
+            self.evaluate_policy(msg)
+        elif fn_name == 'start-clock':
+            self.start_clock(msg)
+        elif fn_name == 'stop-clock':
+            self.stop_clock(msg)
         elif fn_name == 'ask-gpt':
             self.gpt_ask(msg)
         else:
@@ -281,9 +746,301 @@ class Rmq:
     def shutdown(self):
         self.done = True
         #print('RMQ Shut down')
+        self.advisor.shutdown()
+        self.stop_clock_ticks()
+        self.stop_recording()
+        self.envs.close()
+        if self.eval_pool is not None:
+            self.eval_pool.shutdown(wait=False, cancel_futures=True)
+        if self.shm_frames is not None:
+            self.shm_frames.close()
         self.plant.close()
 
 
+class VecRmq(Rmq):
+    """
+    Class to interface RMQ plant messaging for a pool of gym environments,
+    one per plant-id, stepped together through a gymnasium vector env
+    """
+
+    def __init__(self, plantid, exchange, host, port, poolids, vectorization_mode='sync', batch_window=0.005,
+                 encoding='json', **plant_options):
+        Rmq.__init__(self, plantid, exchange, host, port, encoding, **plant_options)
+        self.pool = VecEnvPool(poolids, vectorization_mode)
+        self.slot_frames = {}               # plant-id -> frame encoder for slots using binary frames
+        self.batch_window = batch_window    # seconds to wait for the rest of a batch
+        self.batch_scheduled = False
+        # Commands may also be routed directly to a slot's plant-id
+        self.plant.subscribe(poolids)
+
+    def make_env(self, msg):
+        pid = msg['plant-id']
+        self.plant.started(msg)
+        envname, rendermode = msg['args'][:2]
+        encoding = msg['args'][2] if len(msg['args']) > 2 else self.encoding
+        print('gym make_vec: ', envname, 'slot = ', pid)
+        if not self.pool.has_slot(pid):
+            self.plant.failed(msg, "No pool slot for plant-id " + str(pid))
+            return
+        if not self.valid_encoding(encoding):
+            self.plant.failed(msg, "Unknown observation encoding " + str(encoding))
+            return
+        try:
+            self.pool.make(envname, pid)
+        except ValueError as e:
+            self.plant.failed(msg, str(e))
+            return
+        self.plant.finished(msg)
+        self.plant.observation_keyframe(pid)
+        gym_data_observations = self.make_gym_data_observation(self.pool.observation_space(), self.pool.action_space())
+        self.plant.observations(None, gym_data_observations, copy_observations=False, plantid=pid)
+        self.slot_frames[pid] = self.publish_frame_schema_rmq(encoding, pid, pid + '.frames')
+
+    def reset(self, msg):
+        pid = msg['plant-id']
+        self.plant.started(msg)
+        if pid in self.pool.active:
+            state = self.pool.reset(pid)
+            self.track_reset(pid)
+            encoder = self.slot_frames.get(pid)
+            if encoder is not None:
+                self.plant.binary_publish(pid + '.frames', encoder.encode_state(state, plant.get_time_millis()))
+            else:
+                self.plant.observations(None, self.make_slot_state_observation(state), copy_observations=False, plantid=pid)
+            self.plant.observation_keyframe(pid)
+        self.plant.finished(msg)
+
+    def close(self, msg):
+        self.plant.started(msg)
+        dropped = self.pool.close(msg['plant-id'])
+        if dropped is not None:
+            self.plant.failed(dropped[1], "plant-id " + msg['plant-id'] + " was closed before the action was stepped")
+        self.plant.finished(msg)
+        # The closed slot may have been the last one a batch was waiting for
+        self.maybe_step_batch()
+
+    def render(self, msg):
+        self.plant.started(msg)
+        self.plant.failed(msg, "render is not supported by a vectorized plant")
+
+    def perform_action(self, msg):
+        pid = msg['plant-id']
+        action_name, = msg['args']
+        action_number = int(action_name)
+        if pid in self.pool.active and self.pool.action_space().n > action_number >= 0:
+            if self.pool.latch(pid, action_number, msg):
+                self.maybe_step_batch()
+            else:
+                # The first action is still waiting for the batch, it keeps its place
+                self.plant.failed(msg, "plant-id " + pid + " already has an action pending")
+        else:
+            print('Bad action specified:', action_name, 'for', pid)
+            self.plant.finished(msg)
+
+    def perform_actions(self, msg):
+        self.plant.failed(msg, "perform-actions is not supported by a vectorized plant")
+
+    def train_episodes(self, msg):
+        self.plant.started(msg)
+        self.plant.failed(msg, "train-episodes is not supported by a vectorized plant")
+
+    def evaluate_policy(self, msg):
+        self.plant.started(msg)
+        self.plant.failed(msg, "evaluate-policy is not supported by a vectorized plant")
+
+    def step_pool(self, step):
+        t0 = time.perf_counter()
+        results = step()
+        self.plant.metrics.observe('gym_step_seconds', time.perf_counter() - t0, env='pool')
+        return results
+
+    def maybe_step_batch(self):
+        if self.pool.batch_ready():
+            self.publish_batch(self.step_pool(self.pool.step_batch))
+        elif self.pool.pending and not self.batch_scheduled:
+            self.batch_scheduled = True
+            self.plant.call_later(self.batch_window, self.batch_window_expired)
+
+    def batch_window_expired(self):
+        self.batch_scheduled = False
+        if self.pool.batch_ready():
+            self.publish_batch(self.step_pool(self.pool.step_batch))
+        elif self.pool.pending:
+            # Some learners are slow. An async pool has to wait for them (their next
+            # action completes the batch); a sync pool steps the slots that are ready.
+            results = self.step_pool(self.pool.step_partial)
+            if results is not None:
+                self.publish_batch(results)
+
+    def publish_batch(self, results):
+        for pid, msg, state, reward, terminated, truncated in results:
+            self.track_step(pid, reward, terminated, truncated, state, self.pool.goal_position)
+            encoder = self.slot_frames.get(pid)
+            if encoder is not None:
+                frame = encoder.encode_step(state, reward, terminated, truncated, plant.get_time_millis())
+                self.plant.binary_publish(pid + '.frames', frame)
+                self.plant.finished(msg)
+            else:
+                gym_step_observations = self.make_slot_step_observation(state, reward, terminated)
+                self.plant.observations(None, gym_step_observations, copy_observations=False, plantid=pid,
+                                        finished_msg=msg)
+
+    def make_slot_step_observation(self, state, reward, done):
+        p1=[self.plant.make_observation('reward',  float(reward))]
+        p2=self.make_slot_state_observation(state)
+        p3=[self.plant.make_observation('done',          done)]
+        p4=[self.plant.make_observation('goal_position', 0)]
+        return p1+p2+p3+p4
+
+    def make_slot_state_observation(self, state):
+        return [self.plant.make_observation('state'+str(i), float(state[i])) for i in range(min(self.num_obs, 4))]
+
+    def shutdown(self):
+        self.pool.shutdown()
+        Rmq.shutdown(self)
+
+
+class ReplayRmq(Rmq):
+    """
+    Class to interface RMQ plant messaging that answers reset and perform-action
+    from a trajectory recording instead of a gym environment
+    """
+
+    def __init__(self, plantid, exchange, host, port, replay_path, encoding='json', **plant_options):
+        Rmq.__init__(self, plantid, exchange, host, port, encoding, **plant_options)
+        self.reader = trajectory.TrajectoryReader(replay_path)
+        self.episode = -1
+        self.transition = 0         # next row of the recording
+        self.episode_end = 0
+        self.mismatches = 0         # actions that differ from the recorded ones
+        print('replaying', self.reader.num_transitions, 'transitions in', self.reader.num_episodes(),
+              'episodes of', self.reader.meta['env'])
+
+    def make_env(self, msg):
+        self.plant.started(msg)
+        envname = msg['args'][0]
+        encoding = msg['args'][2] if len(msg['args']) > 2 else self.encoding
+        if envname != self.reader.meta['env']:
+            self.plant.failed(msg, "Replaying " + self.reader.meta['env'] + ", not " + str(envname))
+            return
+        if not self.valid_encoding(encoding):
+            self.plant.failed(msg, "Unknown observation encoding " + str(encoding))
+            return
+        self.envname = envname
+        meta = self.reader.meta
+        self.plant.finished(msg)
+        self.plant.observation_keyframe("gym")
+        observation_space = gym.spaces.Box(np.array(meta['low']), np.array(meta['high']), dtype=meta['obs-dtype'])
+        gym_data_observations = self.make_gym_data_observation(observation_space, gym.spaces.Discrete(meta['num-acts']))
+        self.plant.observations(None, gym_data_observations, copy_observations=False, plantid="gym")
+        self.frames = self.publish_frame_schema_rmq(encoding, "gym", self.frame_routing_key)
+
+    def reset(self, msg):
+        self.plant.started(msg)
+        # Episodes are replayed in recorded order, starting over after the last one.
+        # Episodes without transitions were reset again before any step and are skipped.
+        for i in range(self.reader.num_episodes()):
+            self.episode = (self.episode + 1) % self.reader.num_episodes()
+            self.transition, self.episode_end = self.reader.episode_range(self.episode)
+            if self.transition < self.episode_end:
+                break
+        else:
+            self.plant.failed(msg, "The recording has no transitions")
+            return
+        self.gym_new_state = (self.reader.column('states')[self.transition], {})
+        self.track_reset("gym")
+        self.publish_state_obs_rmq()
+        self.plant.observation_keyframe("gym")
+        self.plant.finished(msg)
+
+    def close(self, msg):
+        self.plant.started(msg)
+        self.plant.finished(msg)
+
+    def render(self, msg):
+        self.plant.started(msg)
+        self.plant.finished(msg)
+
+    def replay_step(self, action_number):
+        # Returns False once the recorded episode is over
+        if self.transition >= self.episode_end:
+            return False
+        row = self.transition
+        if self.reader.column('actions')[row] != action_number:
+            self.mismatches += 1
+        self.gym_new_state = self.reader.column('next-states')[row]
+        self.gym_reward = float(self.reader.column('rewards')[row])
+        self.gym_done = bool(self.reader.column('dones')[row])
+        self.gym_truncated = bool(self.reader.column('truncateds')[row])
+        self.gym_info = {}
+        self.transition += 1
+        self.track_step("gym", self.gym_reward, self.gym_done, self.gym_truncated, self.gym_new_state)
+        return True
+
+    def perform_action(self, msg):
+        action_name, = msg['args']
+        if self.replay_step(int(action_name)):
+            self.publish_step_obs_rmq(msg)
+        else:
+            print('Replay: episode', self.episode, 'has no more transitions')
+            self.plant.finished(msg)
+
+    def perform_actions(self, msg):
+        args = msg['args']
+        if len(args) == 2:
+            action_names = [args[0]] * int(args[1])
+        else:
+            action_names, = args
+        states = []
+        rewards = []
+        dones = []
+        truncateds = []
+        for action_name in action_names:
+            if not self.replay_step(int(action_name)):
+                break
+            states.append([float(x) for x in self.gym_new_state])
+            rewards.append(float(self.gym_reward))
+            dones.append(self.gym_done)
+            truncateds.append(self.gym_truncated)
+            if self.gym_done or self.gym_truncated:
+                break
+        if states:
+            self.publish_steps_obs_rmq(states, rewards, dones, truncateds, msg)
+        else:
+            self.plant.finished(msg)
+
+    def train_episodes(self, msg):
+        self.plant.started(msg)
+        self.plant.failed(msg, "train-episodes is not supported when replaying")
+
+    def evaluate_policy(self, msg):
+        self.plant.started(msg)
+        self.plant.failed(msg, "evaluate-policy is not supported when replaying")
+
+    def shutdown(self):
+        print('replayed up to episode', self.episode, 'with', self.mismatches, 'actions differing from the recording')
+        Rmq.shutdown(self)
+
+
+class AsyncRmq(Rmq):
+    """
+    Class to interface RMQ plant messaging through the asyncio plant, so that
+    slow commands such as ask-gpt and render do not hold up stepping
+    """
+
+    def __init__(self, *args, **kwargs):
+        import aio_plant
+        self.plant_class = aio_plant.AsyncPlant
+        Rmq.__init__(self, *args, **kwargs)
+
+    def subscribe_and_wait(self):
+        import asyncio
+        try:
+            asyncio.run(self.plant.run(self.dispatch_func))
+        except KeyboardInterrupt:
+            print("Keyboard interrupt, perhaps Control-C.")
+
+
 def on_gym_shutdown():
     try:
         rmq.shutdown()
@@ -291,11 +1048,75 @@ def on_gym_shutdown():
         print('Ignoring as we are shutting down', e.__class__.__name__ + ": " + e.message)
 
 
+def make_plant_options(args):
+    return {'publish_batch_size': args.publish_batch,
+            'publisher_confirms': args.confirms,
+            'stats_interval': args.publish_stats,
+            'prefetch_count': args.prefetch,
+            'ack_batch': args.ack_batch,
+            'max_outbound': args.max_outbound,
+            'metrics_interval': args.metrics_interval,
+            'publisher_connections': args.publisher_connections,
+            'observation_mode': args.observation_mode,
+            'keyframe_interval': args.keyframe_interval}
+
+
+def start_metrics_server(args, rmq, port_offset=0):
+    if args.metrics_port > 0:
+        return metrics.MetricsServer(rmq.plant.metrics, args.metrics_port + port_offset).start()
+    return None
+
+
+def make_advisor(args, rmq):
+    cache = gpt_cache.ResponseCache(args.gpt_cache, args.gpt_cache_size, args.gpt_cache_ttl)
+    completion = gpt_cache.stub_completion if args.gpt_backend == 'stub' else rmq.openai_completion
+    return gpt_cache.GptAdvisor(completion, cache)
+
+
+def make_pool_ids(args):
+    return [args.pool_prefix + '-' + str(i) for i in range(args.num_envs)]
+
+
+def configure(args, rmq, metrics_port_offset=0):
+    rmq.advisor = make_advisor(args, rmq)
+    rmq.envs = env_cache.EnvCache(args.env_cache_size)
+    rmq.record_dir = args.record
+    rmq.eval_workers = args.eval_workers
+    rmq.step_rate = args.step_rate
+    rmq.episode_stats_window = args.episode_stats
+    rmq.episode_stats_interval = args.episode_stats_interval
+    if args.shm_frames > 0:
+        import shm_frames
+        rmq.shm_frames = shm_frames.FrameRing('dmrl-' + str(os.getpid()), args.shm_frames)
+    start_metrics_server(args, rmq, metrics_port_offset)
+
+
+def report_startup(rmq, started):
+    # started is a time.perf_counter() value: module load for a cold start, the fork for a warm one
+    ready_seconds = time.perf_counter() - started
+    print('startup: imports %.3f s, ready to consume %.3f s' % (import_seconds, ready_seconds))
+    rmq.plant.metrics.gauge('plant_import_seconds', lambda: import_seconds, 'gym_plant module import time')
+    rmq.plant.metrics.gauge('plant_startup_seconds', lambda: ready_seconds, 'time until the plant was ready to consume')
+
+
 def main(args):
     global rmq
 
     print("plantid=", args.plantid, "exchange=", args.exchange, "host=", args.host, "port=", args.port)
-    rmq = Rmq(args.plantid, args.exchange, args.host, args.port)
+    plant_options = make_plant_options(args)
+    if args.asyncio:
+        rmq = AsyncRmq(args.plantid, args.exchange, args.host, args.port, args.encoding, **plant_options)
+    elif args.replay is not None:
+        rmq = ReplayRmq(args.plantid, args.exchange, args.host, args.port, args.replay, args.encoding, **plant_options)
+    elif args.num_envs > 0:
+        poolids = make_pool_ids(args)
+        print("vectorized pool of", args.num_envs, "envs:", poolids)
+        rmq = VecRmq(args.plantid, args.exchange, args.host, args.port,
+                     poolids, args.vector_mode, args.batch_window, args.encoding, **plant_options)
+    else:
+        rmq = Rmq(args.plantid, args.exchange, args.host, args.port, args.encoding, **plant_options)
+    configure(args, rmq)
+    report_startup(rmq, startup_started)
 
     try:
         rmq.subscribe_and_wait()
@@ -304,14 +1125,83 @@ def main(args):
 
     print('Done gym_plant main')
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='Gym Plant')
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be at least 1, got ' + value)
+    return number
+
+
+def make_arg_parser(description='Gym Plant'):
+    parser = argparse.ArgumentParser(description=description)
     parser.add_argument('--host', default='localhost', help='RMQ host')
     parser.add_argument('-p', '--port', default=5672, help='RMQ Port', type=int)
     parser.add_argument('-e', '--exchange', default='dmrl', help='RMQ Exchange')
     parser.add_argument('--plantid', default="dmrl", help='default plant id')
+    parser.add_argument('-n', '--num-envs', default=0, type=int,
+                        help='serve a vectorized pool of this many envs, plant-ids <pool-prefix>-0 .. <pool-prefix>-N-1')
+    parser.add_argument('--pool-prefix', default='gym', help='plant-id prefix of the pool slots')
+    parser.add_argument('--vector-mode', default='sync', choices=['sync', 'async'],
+                        help='gymnasium vectorization mode; async runs envs in subprocesses and steps in lockstep')
+    parser.add_argument('--batch-window', default=0.005, type=float,
+                        help='seconds to wait for every pool slot to send its action before stepping')
+    parser.add_argument('--encoding', default='json', choices=['json', 'float32', 'float64'],
+                        help='default observation encoding; float32/float64 publish binary frames on <plant-id>.frames')
+    parser.add_argument('--publish-batch', default=100, type=int,
+                        help='max outbound messages published per wakeup of the connection thread')
+    parser.add_argument('--confirms', action='store_true', help='use RMQ publisher confirms')
+    parser.add_argument('--publish-stats', default=0, type=int,
+                        help='print publish latency stats every this many messages, 0 for only at close')
+    parser.add_argument('--prefetch', default=0, type=int, help='max unacked commands delivered by RMQ, 0 for unlimited')
+    parser.add_argument('--ack-batch', default=1, type=int, help='ack received commands this many at a time')
+    parser.add_argument('--publisher-connections', default=0, type=int,
+                        help='let up to this many worker threads publish on connections of their own, 0 for none')
+    parser.add_argument('--max-outbound', default=0, type=int,
+                        help='stop taking commands while more than this many messages wait to be published, 0 for no limit')
+    parser.add_argument('--observation-mode', default='full', choices=['full', 'delta'],
+                        help='delta sends only changed observation fields, with finished in the same message')
+    parser.add_argument('--keyframe-interval', default=100, type=int,
+                        help='in delta mode, send every field once per this many messages of a plant-id')
+
+    parser.add_argument('--metrics-port', default=0, type=int,
+                        help='serve Prometheus metrics on this local port, 0 for none')
+    parser.add_argument('--metrics-interval', default=0, type=float,
+                        help='publish a plant-metrics observation every this many seconds, 0 for none')
+    parser.add_argument('--record', default=None,
+                        help='record every transition under this directory, one recording per make_env')
+    parser.add_argument('--replay', default=None,
+                        help='answer reset and perform-action from this recording instead of a gym env')
+    parser.add_argument('--step-rate', default=0, type=float,
+                        help='default rate in Hz at which start-clock steps the env with the latched action')
+    parser.add_argument('--episode-stats', default=0, type=int,
+                        help='keep rolling stats of this many episodes, published on <plant-id>.episode-stats')
+    parser.add_argument('--episode-stats-interval', default=0, type=float,
+                        help='seconds between episode stats summaries, 0 for one per finished episode')
+    parser.add_argument('--eval-workers', default=os.cpu_count() or 1, type=positive_int,
+                        help='processes running evaluate-policy seeds and train-episodes runs in parallel')
+    parser.add_argument('--shm-frames', default=0, type=int,
+                        help='ring of this many shared memory slots for pixel observations and rgb_array renders')
+    parser.add_argument('--env-cache-size', default=4, type=int,
+                        help='idle gym env instances kept for reuse across render mode switches')
+
+    parser.add_argument('--asyncio', action='store_true',
+                        help='use the asyncio plant, running ask-gpt and render in a thread pool')
+    parser.add_argument('--gpt-backend', default='openai', choices=['openai', 'stub'],
+                        help='completion backend for ask-gpt, stub answers offline')
+    parser.add_argument('--gpt-cache', default=None, help='sqlite file to keep ask-gpt responses across runs')
+    parser.add_argument('--gpt-cache-size', default=256, type=int, help='max cached ask-gpt responses')
+    parser.add_argument('--gpt-cache-ttl', default=None, type=float, help='seconds before a cached response expires')
+    return parser
 
+
+if __name__ == "__main__":
+    parser = make_arg_parser()
     args = parser.parse_args()
+    if args.asyncio and args.num_envs > 0:
+        parser.error('--asyncio cannot be combined with --num-envs')
+    if (args.record is not None or args.replay is not None) and (args.asyncio or args.num_envs > 0):
+        parser.error('--record and --replay are only supported by the single env plant')
     pprint(args)
     main(args)
     sys.exit(0)
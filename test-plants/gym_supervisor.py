@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Dynamic Object Language Labs Inc.
+#
+# This software is licensed under the terms of the
+# Apache License, Version 2.0 which can be found in
+# the file LICENSE at the root of this distribution.
+
+import sys
+import time
+import signal
+import multiprocessing
+from pprint import pprint
+
+import gym_plant
+
+'''
+Supervisor for a process-sharded gym plant
+
+Forks --workers processes, each serving a vectorized pool of a subset of
+the plant-ids <pool-prefix>-0 .. <pool-prefix>-N-1.  Every worker opens
+its own RMQ connection and binds only the plant-ids it owns, so commands
+must be routed by plant-id.  A worker that exits is restarted with the
+same plant-ids; learners of those plant-ids have to make_env again.
+SIGTERM or SIGINT to the supervisor stops the workers before it exits.
+'''
+
+
+def shard(poolids, num_workers):
+    return [poolids[k::num_workers] for k in range(num_workers)]
+
+
+def run_worker(args, poolids, k):
+    # The fork inherits the supervisor's handlers, the worker is stopped the default way
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    print('worker', multiprocessing.current_process().name, 'serving', poolids)
+    # No default plant id: the worker must not bind the routing key shared by its siblings
+    gym_plant.rmq = gym_plant.VecRmq(None, args.exchange, args.host, args.port,
+                                     poolids, args.vector_mode, args.batch_window, args.encoding,
+                                     **gym_plant.make_plant_options(args))
+    # Worker k serves its metrics on --metrics-port + k
+    gym_plant.configure(args, gym_plant.rmq, k)
+    gym_plant.rmq.subscribe_and_wait()
+    gym_plant.on_gym_shutdown()
+
+
+class Supervisor:
+    def __init__(self, args, shards, restart_delay=1.0, poll_interval=0.5):
+        self.args = args
+        self.shards = shards
+        self.restart_delay = restart_delay
+        self.poll_interval = poll_interval
+        self.context = multiprocessing.get_context('fork')
+        self.workers = {}
+        self.restarts = [0] * len(shards)
+        self.stopping = False
+
+    def start_worker(self, k):
+        # Not a daemon, so that an async vector env can start its own subprocesses
+        p = self.context.Process(target=run_worker, args=(self.args, self.shards[k], k), name='gym-worker-' + str(k))
+        p.start()
+        self.workers[k] = p
+        print('started worker', k, 'pid', p.pid)
+
+    def on_signal(self, signum, frame):
+        print('supervisor got signal', signum, 'stopping the workers')
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.on_signal)
+        signal.signal(signal.SIGINT, self.on_signal)
+        for k in range(len(self.shards)):
+            self.start_worker(k)
+        try:
+            while not self.stopping:
+                for k, p in list(self.workers.items()):
+                    if not p.is_alive() and not self.stopping:
+                        self.restarts[k] += 1
+                        print('worker', k, 'exited with code', p.exitcode, 'restart', self.restarts[k])
+                        time.sleep(self.restart_delay)
+                        if not self.stopping:
+                            self.start_worker(k)
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            print("Keyboard interrupt, perhaps Control-C.")
+        self.stop()
+
+    def stop(self):
+        self.stopping = True
+        for p in self.workers.values():
+            if p.is_alive():
+                p.terminate()
+        for p in self.workers.values():
+            p.join(5)
+            if p.is_alive():
+                p.kill()
+                p.join()
+        print('stopped', len(self.workers), 'workers, restarts', self.restarts)
+
+
+def main(args):
+    poolids = gym_plant.make_pool_ids(args)
+    shards = [s for s in shard(poolids, args.workers) if s]
+    print('supervising', len(shards), 'workers for', poolids)
+    Supervisor(args, shards, args.restart_delay).run()
+    print('Done gym_supervisor main')
+
+
+if __name__ == "__main__":
+    parser = gym_plant.make_arg_parser('Process-sharded Gym Plant')
+    parser.add_argument('-w', '--workers', default=multiprocessing.cpu_count(), type=int,
+                        help='number of worker processes, defaults to the number of cores')
+    parser.add_argument('--restart-delay', default=1.0, type=float, help='seconds to wait before restarting a worker')
+    args = parser.parse_args()
+    if args.num_envs < 1:
+        parser.error('--num-envs must be given, the plant-ids are sharded across the workers')
+    if args.asyncio:
+        parser.error('--asyncio is not supported by the supervisor')
+    if args.record is not None or args.replay is not None:
+        parser.error('--record and --replay are not supported by the supervisor')
+    pprint(args)
+    main(args)
+    sys.exit(0)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Dynamic Object Language Labs Inc.
+#
+# This software is licensed under the terms of the
+# Apache License, Version 2.0 which can be found in
+# the file LICENSE at the root of this distribution.
+
+import bisect
+import threading
+import time
+
+'''
+Hot path instrumentation for plants
+
+Metrics keeps latency histograms, counters and gauges, labelled with
+keyword arguments such as function='perform-action'.  Recording is a lock,
+a bisect and a few additions, cheap enough for every command and publish.
+
+The metrics are read either in Prometheus text format from MetricsServer,
+a local HTTP endpoint, or as a compact summary suitable for an
+observation message.
+'''
+
+# Seconds, from 50us to 10s
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)      # the last count is for +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q quantile.  Past the top bucket this is the
+        # top bound, never inf, which json.dumps would write as a bare Infinity; see overflow.
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n > 0:
+                return self.buckets[min(i, len(self.buckets) - 1)]
+        return self.buckets[-1]
+
+    def overflow(self):
+        # Observations above the top bucket
+        return self.counts[-1]
+
+
+def label_text(labels, extra=None):
+    items = list(labels) + ([extra] if extra is not None else [])
+    if not items:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items) + '}'
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}        # (name, labels) -> Histogram
+        self.counters = {}          # (name, labels) -> count
+        self.gauges = {}            # name -> function returning the current value
+        self.help = {}              # name -> help text
+        self.last_summary = (time.monotonic(), {})
+
+    def describe(self, name, help_text):
+        self.help[name] = help_text
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def gauge(self, name, fn, help_text=None):
+        self.gauges[name] = fn
+        if help_text is not None:
+            self.help[name] = help_text
+
+    def render(self):
+        """
+        All metrics in Prometheus text exposition format.
+        """
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append('# HELP %s %s' % (name, self.help[name]))
+                lines.append('# TYPE %s %s' % (name, kind))
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                header(name, 'counter')
+                lines.append('%s%s %d' % (name, label_text(labels), value))
+            for (name, labels), h in sorted(self.histograms.items()):
+                header(name, 'histogram')
+                cumulative = 0
+                for bound, n in zip(list(h.buckets) + ['+Inf'], h.counts):
+                    cumulative += n
+                    lines.append('%s_bucket%s %d' % (name, label_text(labels, ('le', bound)), cumulative))
+                lines.append('%s_sum%s %.9f' % (name, label_text(labels), h.sum))
+                lines.append('%s_count%s %d' % (name, label_text(labels), h.count))
+        for name, fn in sorted(self.gauges.items()):
+            header(name, 'gauge')
+            lines.append('%s %s' % (name, fn()))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        Counter rates since the previous summary, gauges, and p50/p99 ms of every histogram, with
+        the number of observations above the top bucket, whose quantiles are clamped to it.
+        """
+        now = time.monotonic()
+        with self.lock:
+            last_time, last_counts = self.last_summary
+            counts = dict(self.counters)
+            elapsed = max(now - last_time, 1e-9)
+            result = {'rates': dict((name + label_text(labels), (n - last_counts.get((name, labels), 0)) / elapsed)
+                                    for (name, labels), n in counts.items()),
+                      'latency-ms': dict((name + label_text(labels),
+                                          {'count': h.count,
+                                           'p50': h.quantile(0.5) * 1000.0,
+                                           'p99': h.quantile(0.99) * 1000.0,
+                                           'overflow': h.overflow()})
+                                         for (name, labels), h in self.histograms.items() if h.count > 0)}
+            self.last_summary = (now, counts)
+        result['gauges'] = dict((name, fn()) for name, fn in self.gauges.items())
+        return result
+
+
+class MetricsServer:
+    """
+    Serves metrics.render() on http://host:port/metrics from a daemon thread
+    """
+
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        import http.server          # Only plants serving metrics pay for it
+        self.metrics = metrics
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] not in ('/', '/metrics'):
+                    handler.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'text/plain; version=0.0.4')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                pass                # Scrapes are too frequent to log
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics-server', daemon=True)
+        self.thread.start()
+        print('metrics on http://%s:%d/metrics' % self.server.server_address[:2])
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
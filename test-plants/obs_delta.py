@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Dynamic Object Language Labs Inc.
+#
+# This software is licensed under the terms of the
+# Apache License, Version 2.0 which can be found in
+# the file LICENSE at the root of this distribution.
+
+import threading
+
+'''
+Delta encoding of observation messages
+
+Step observations resend every field each step, most of them unchanged
+(goal_position, done, the bounds).  DeltaEncoder remembers the last value
+sent for each field of each (routing key, plant-id) stream and passes on
+only the observations whose value changed.  Learners keep the latest value
+of every field already, so they apply a delta as is.
+
+Every keyframe_interval messages of a stream, and on the first message or
+after keyframe(plantid), the message is sent whole and marked as a
+keyframe, so a consumer that joined late or lost a message catches up.
+'''
+
+
+class DeltaEncoder:
+    def __init__(self, keyframe_interval=100):
+        self.keyframe_interval = keyframe_interval      # 0 for only the first message of a stream
+        self.lock = threading.Lock()    # Worker threads publish observations too
+        self.streams = {}               # (routing key, plant-id) -> [messages since keyframe, {field: value}]
+        self.fields_sent = 0
+        self.fields_suppressed = 0
+
+    def encode(self, routing_key, plantid, obs_vec):
+        """
+        Returns (observations to send, keyframe).  The observation dicts are passed on, not copied.
+        """
+        with self.lock:
+            stream = self.streams.get((routing_key, plantid))
+            keyframe = stream is None or (self.keyframe_interval > 0 and stream[0] >= self.keyframe_interval)
+            if keyframe:
+                stream = self.streams[(routing_key, plantid)] = [0, {}]
+            stream[0] += 1
+            last = stream[1]
+            changed = []
+            for obs in obs_vec:
+                field = obs['field']
+                value = obs['value']
+                if keyframe or field not in last or last[field] != value:
+                    last[field] = value
+                    changed.append(obs)
+            self.fields_sent += len(changed)
+            self.fields_suppressed += len(obs_vec) - len(changed)
+        return changed, keyframe
+
+    def keyframe(self, plantid=None):
+        """
+        Send the next message of plantid's streams, or of all streams, whole.
+        """
+        with self.lock:
+            for key in list(self.streams):
+                if plantid is None or key[1] == plantid:
+                    del self.streams[key]
@@ -11,6 +11,9 @@ import json
 import time
 import threading
 import collections
+import transport
+import metrics
+import obs_delta
 
 '''
 Helper functions for plant interface
@@ -41,25 +44,63 @@ def to_object(body):
 
 
 class Plant:
-    def __init__(self, plantid, exchange, host='localhost', port=5672):
+    def __init__(self, plantid, exchange, host='localhost', port=5672,
+                 publish_batch_size=100, publisher_confirms=False, stats_interval=0,
+                 prefetch_count=0, ack_batch=1, max_outbound=0, msg_transport=None, metrics_interval=0,
+                 publisher_connections=0, observation_mode='full', keyframe_interval=100):
         self.plantid = plantid
         self.exchange = exchange
         self.routing_key = 'observations'
         self.host = host
         self.port = port
         self.cb_function = None
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host, port))
-        self.channel = self.connection.channel()
+        # RabbitMQ unless another transport, such as transport.LoopbackTransport, is given
+        if msg_transport is None:
+            msg_transport = transport.PikaTransport(host, port)
+        self.transport = msg_transport
         # Sending messages to channel must be called from the same thread as the one creating this one.
+        # Other threads enqueue to to_rmq and wake the connection thread, which drains it in batches.
         self.to_rmq = collections.deque()
-        self.connection.add_callback_threadsafe(self.rmq_is_idle)
+        self.wakeup_lock = threading.Lock()
+        self.wakeup_pending = False
+        self.stats_lock = threading.Lock()
+        # Optionally, up to publisher_connections other threads publish directly on connections of their own.
+        # Messages keep their order per thread only: a worker's finished may reach the broker before the
+        # started the consumer thread sent for the same command.  The learner only waits for finished.
+        self.publishers = None
+        if publisher_connections > 0:
+            self.publishers = transport.PublisherPool(self.transport.open_publisher, publisher_connections,
+                                                      publisher_confirms)
+        self.publish_batch_size = publish_batch_size
+        self.publisher_confirms = publisher_confirms
+        self.stats_interval = stats_interval    # print publish stats every this many messages, 0 for never
+        self.publish_stats = {'published': 0, 'nacked': 0, 'batches': 0,
+                              'queue-ms-total': 0.0, 'queue-ms-max': 0.0,
+                              'publish-ms-total': 0.0, 'publish-ms-max': 0.0}
+        # Consumer flow control: at most prefetch_count unacked messages (0 is unlimited),
+        # acked ack_batch at a time, and stop consuming while more than max_outbound are waiting to go out.
+        self.prefetch_count = prefetch_count
+        self.ack_batch = max(1, ack_batch)
+        if prefetch_count > 0 and self.ack_batch > prefetch_count:
+            self.ack_batch = prefetch_count     # Otherwise the broker stops delivering before we ack
+        self.max_outbound = max_outbound
+        self.unacked = 0
+        self.last_delivery_tag = None
+        # 'delta' sends only the observations that changed and merges finished into the observations message
+        self.delta = obs_delta.DeltaEncoder(keyframe_interval) if observation_mode == 'delta' else None
+        self.init_metrics(metrics_interval)
+        self.metrics.gauge('plant_outbound_queue_depth', lambda: len(self.to_rmq),
+                           'messages waiting in to_rmq to be published')
         self.channel_thread = threading.current_thread()
-        self.channel.exchange_declare(exchange=exchange, exchange_type='topic')
-        self.queue = self.channel.queue_declare('', exclusive=True)
-        self.qname = self.queue.method.queue
+        if publisher_confirms:
+            # With the blocking adapter each publish waits for its broker confirm,
+            # so at most publish_batch_size messages are drained before yielding to the connection.
+            self.transport.enable_confirms()
+        self.transport.declare_exchange(exchange)
+        self.qname = self.transport.declare_queue()
         self.done = False
         if plantid is not None:
-            self.channel.queue_bind(queue=self.qname, exchange=exchange, routing_key=plantid)
+            self.transport.bind(self.qname, exchange, plantid)
         print('Plant instance created by thread:', self.channel_thread.name)
 
     def myprint(self):
@@ -68,19 +109,22 @@ class Plant:
 
     def subscribe(self, keys):
         for key in keys:
-            self.channel.queue_bind(queue=self.qname, exchange=self.exchange, routing_key=key)
+            self.transport.bind(self.qname, self.exchange, key)
 
     def wait_for_messages(self, cb_fn_name):
         self.myprint()
         print("Waiting for commands")
-        # Tell the broker that we won't be providing explicit acks for messages received.
         self.cb_function = cb_fn_name
-        self.channel.basic_consume(self.qname, self.message_receiver_internal, auto_ack=False) #Before, no_ack=True
+        if self.prefetch_count > 0:
+            self.transport.set_prefetch(self.prefetch_count)
+        # Messages are acked explicitly once the callback has handled them, see message_receiver_internal
+        self.transport.consume(self.qname, self.message_receiver_internal)
+        self.schedule_metrics_report()
         self.wait_until_keyboard_interrupt()
 
     def wait_until_keyboard_interrupt(self):
         try:
-            self.channel.start_consuming()
+            self.transport.start_consuming()
         except KeyboardInterrupt:
             print("Keyboard interrupt, perhaps Control-C.")
         except pika.exceptions.ConnectionClosed:
@@ -90,20 +134,45 @@ class Plant:
         # print( 'plant.py done ')
 
     def message_receiver_internal(self, channel, method, properties, body):
+        if self.max_outbound > 0 and len(self.to_rmq) > self.max_outbound:
+            # Backpressure: publish what we owe before taking on more work
+            self.process_to_rmq()
         msg = to_object(body)
         #print("Dispatching received plant message method: " + str(method))
         #print("Dispatching received plant message properties: " + str(properties))
         #print("Dispatching received plant message body: " + str(msg))
-        self.cb_function(msg, method.routing_key)
+        self.record_received(msg)
+        t0 = time.perf_counter()
+        try:
+            self.cb_function(msg, method.routing_key)
+        finally:
+            self.metrics.observe('plant_handler_seconds', time.perf_counter() - t0,
+                                 function=msg.get('function-name'))
+            self.ack(method.delivery_tag)
+
+    def ack(self, delivery_tag):
+        self.unacked += 1
+        self.last_delivery_tag = delivery_tag
+        if self.unacked >= self.ack_batch:
+            self.flush_acks()
+
+    def flush_acks(self):
+        if self.unacked > 0:
+            self.transport.ack(self.last_delivery_tag, multiple=True)
+            self.unacked = 0
 
     def close(self):
         print("closing rmq connection")
         while self.to_rmq:
             print( 'plant closing, process pending messages', len(self.to_rmq))
             self.process_to_rmq()
+        self.print_publish_stats()
+        if self.transport.is_open():
+            self.flush_acks()
+        if self.publishers is not None:
+            self.publishers.close()
 
-        self.channel.close()
-        self.connection.close()
+        self.transport.close()
 
     def get_plantId(self, msg):
 
@@ -125,31 +194,33 @@ class Plant:
                'args': args,
                'argsmap': argsmap,
                'timestamp': timestamp}
-        self.__enque_to_rmq(self.exchange, plant_id, json.dumps(msg))
+        self._enque_to_rmq(self.exchange, plant_id, json.dumps(msg))
 
     def started(self, orig_msg):
         msg = {'id': orig_msg['id'],
                'plant-id': self.get_plantId(orig_msg),
                'state': 'started',
                'timestamp': get_time_millis()}
-        self.__enque_to_rmq(self.exchange, self.routing_key, json.dumps(msg))
+        self._enque_to_rmq(self.exchange, self.routing_key, json.dumps(msg))
 
     def failed(self, orig_msg, failure_message):
+        self.record_finished(orig_msg, 'failed')
         msg = {'id': orig_msg['id'],
                'plant-id': self.get_plantId(orig_msg),
                'state': 'finished',
                'timestamp': get_time_millis(),
                'reason': {'finish-state': 'failed',
                           'failed-reason': failure_message}}
-        self.__enque_to_rmq(self.exchange, self.routing_key, json.dumps(msg))
+        self._enque_to_rmq(self.exchange, self.routing_key, json.dumps(msg))
 
     def finished(self, orig_msg):
+        self.record_finished(orig_msg, 'success')
         msg = {'id': orig_msg['id'],
                'plant-id': self.get_plantId(orig_msg),
                'state': 'finished',
                'timestamp': get_time_millis(),
                'reason': {'finish-state': 'success'}}
-        self.__enque_to_rmq(self.exchange, self.routing_key, json.dumps(msg))
+        self._enque_to_rmq(self.exchange, self.routing_key, json.dumps(msg))
 
     def make_observation(self, key, value, timestamp=None):
         if timestamp is not None:
@@ -157,17 +228,18 @@ class Plant:
         else:
             return {'field': key, 'value': value}
 
-    def observations(self, orig_msg, obs_vec, timestamp=get_time_millis(), copy_observations=True, plantid = None):
+    def observations(self, orig_msg, obs_vec, timestamp=None, copy_observations=True, plantid = None,
+                     routing_key=None, finished_msg=None):
+        # finished_msg, when given, is finished after the observations are published:
+        # in the same message in delta mode, otherwise by a finished message of its own.
+        if timestamp is None:
+            timestamp = get_time_millis()
+        if routing_key is None:
+            routing_key = self.routing_key
         obs_vec_copy = obs_vec
         if copy_observations is True:
-            print( 'Make a copy of observations')
-            obs_vec_copy = []
-            for obs in obs_vec:
-                obs_copy = obs.copy()
-                # pprint.pprint(obs_copy)
-                if 'timestamp' not in obs_copy:
-                    obs_copy['timestamp'] = timestamp
-                obs_vec_copy.append(obs_copy)
+            # Only observations without a timestamp of their own are copied, to add one
+            obs_vec_copy = [obs if 'timestamp' in obs else dict(obs, timestamp=timestamp) for obs in obs_vec]
 
         msg = {}
         if orig_msg is not None:
@@ -180,33 +252,169 @@ class Plant:
 
         msg['state'] = 'observations'
         msg['timestamp'] = timestamp
+        merge_finished = finished_msg is not None and self.delta is not None and routing_key == self.routing_key
+        if self.delta is not None:
+            obs_vec_copy, msg['keyframe'] = self.delta.encode(routing_key, msg['plant-id'], obs_vec_copy)
+            if merge_finished:
+                self.record_finished(finished_msg, 'success')
+                msg['finished'] = {'id': finished_msg['id'],
+                                   'plant-id': self.get_plantId(finished_msg),
+                                   'reason': {'finish-state': 'success'}}
         msg['observations'] = obs_vec_copy
-        self.__enque_to_rmq(self.exchange, self.routing_key, json.dumps(msg))
+        t0 = time.perf_counter()
+        data = json.dumps(msg)
+        self.metrics.observe('plant_serialize_seconds', time.perf_counter() - t0, encoding='json')
+        self._enque_to_rmq(self.exchange, routing_key, data)
+        if finished_msg is not None and not merge_finished:
+            self.finished(finished_msg)
+
+    def observation_keyframe(self, plantid=None):
+        # In delta mode, send the next observations of plantid, or of every plant-id, whole
+        if self.delta is not None:
+            self.delta.keyframe(plantid)
 
     def binary_publish(self, routing_key, data):
         # print( 'publishing data of len {}'.format(len(data)))
         properties = pika.BasicProperties(content_type='application/x-binary')
-        self.__enque_to_rmq(self.exchange, routing_key, data, properties)
+        self._enque_to_rmq(self.exchange, routing_key, data, properties)
         # print( '---- done my generic_publish\n')
 
-    def process_to_rmq(self):
+    def process_to_rmq(self, max_messages=None):
         n_waiting = len(self.to_rmq)
+        if max_messages is not None:
+            n_waiting = min(n_waiting, max_messages)
 
         if n_waiting > 0:
+            with self.stats_lock:
+                self.publish_stats['batches'] += 1
             for i in range(n_waiting):
-                # print( 'plant.rmq_is_idle is sending ', n_waiting)
+                # print( 'plant.process_to_rmq is sending ', n_waiting)
                 msg = self.to_rmq.popleft()
+                now = get_time_millis()
                 self.__basic_publish(msg['exchange'], msg['routing-key'], msg['data'], msg['properties'])
-
-    def rmq_is_idle(self):
-        # This method is called whenever RMQ has free time.
-        # We send messages to rmq on behalf of all threads
-        self.process_to_rmq()
-        if not self.done:
-            self.connection.add_callback_threadsafe(self.rmq_is_idle)
-
-    def __enque_to_rmq(self, exchange, routing_key, data, properties=None):
-        self.to_rmq.append({'exchange': exchange, 'routing-key': routing_key, 'data': data, 'properties': properties})
+                self.record_publish(now - msg['enqueued'], get_time_millis() - now)
+
+    def rmq_wakeup(self):
+        # Called on the connection thread after messages were enqueued.
+        # We send messages to rmq on behalf of all threads, a batch at a time
+        # so that incoming messages are not starved by a long outbound queue.
+        with self.wakeup_lock:
+            self.wakeup_pending = False
+        self.process_to_rmq(self.publish_batch_size)
+        if self.to_rmq:
+            self.request_wakeup()
+
+    def request_wakeup(self):
+        with self.wakeup_lock:
+            if self.wakeup_pending:
+                return
+            self.wakeup_pending = True
+        self.transport.add_callback_threadsafe(self.rmq_wakeup)
+
+    def call_later(self, delay, callback):
+        # Run callback on the connection thread after delay seconds
+        self.transport.call_later(delay, callback)
+
+    # Instrumentation, see metrics
+
+    def init_metrics(self, metrics_interval=0):
+        self.metrics = metrics.Metrics()
+        self.metrics_interval = metrics_interval    # seconds between metrics observations, 0 for none
+        self.receive_times = {}                     # command id -> (function name, receive time)
+        self.metrics.describe('plant_command_seconds', 'receive to finished time of commands')
+        self.metrics.describe('plant_handler_seconds', 'time in the command callback on the consumer thread')
+        self.metrics.describe('plant_serialize_seconds', 'time to encode observations')
+        self.metrics.describe('plant_queue_seconds', 'time messages waited in the outbound queue')
+        self.metrics.describe('plant_publish_seconds', 'time to hand a message to the broker')
+        if self.delta is not None:
+            self.metrics.gauge('plant_delta_fields_sent', lambda: self.delta.fields_sent,
+                               'observation fields published in delta mode')
+            self.metrics.gauge('plant_delta_fields_suppressed', lambda: self.delta.fields_suppressed,
+                               'unchanged observation fields left out in delta mode')
+
+    def record_received(self, msg):
+        self.metrics.inc('plant_messages_received_total')
+        if 'id' in msg and 'function-name' in msg:
+            self.receive_times[msg['id']] = (msg['function-name'], time.perf_counter())
+
+    def record_finished(self, orig_msg, outcome):
+        received = self.receive_times.pop(orig_msg.get('id'), None) if orig_msg is not None else None
+        if received is not None:
+            self.metrics.observe('plant_command_seconds', time.perf_counter() - received[1],
+                                 function=received[0], outcome=outcome)
+
+    def schedule_metrics_report(self):
+        if self.metrics_interval > 0:
+            self.call_later(self.metrics_interval, self.publish_metrics)
+
+    def publish_metrics(self):
+        # Runs on the connection thread every metrics_interval seconds
+        obs = [self.make_observation('plant-metrics', self.metrics.summary())]
+        self.observations(None, obs, get_time_millis(), copy_observations=False)
+        self.schedule_metrics_report()
+
+    def record_publish(self, queue_ms, publish_ms):
+        self.metrics.inc('plant_messages_published_total')
+        self.metrics.observe('plant_queue_seconds', queue_ms / 1000.0)
+        self.metrics.observe('plant_publish_seconds', publish_ms / 1000.0)
+        stats = self.publish_stats
+        with self.stats_lock:       # Direct publishers record from their own threads
+            stats['published'] += 1
+            stats['queue-ms-total'] += queue_ms
+            stats['queue-ms-max'] = max(stats['queue-ms-max'], queue_ms)
+            stats['publish-ms-total'] += publish_ms
+            stats['publish-ms-max'] = max(stats['publish-ms-max'], publish_ms)
+            report = self.stats_interval > 0 and stats['published'] % self.stats_interval == 0
+        if report:
+            self.print_publish_stats()
+
+    def print_publish_stats(self):
+        stats = self.publish_stats
+        n = max(stats['published'], 1)
+        print('published', stats['published'], 'in', stats['batches'], 'batches, nacked', stats['nacked'],
+              'queue ms avg/max %.3f/%.3f' % (stats['queue-ms-total'] / n, stats['queue-ms-max']),
+              'publish ms avg/max %.3f/%.3f' % (stats['publish-ms-total'] / n, stats['publish-ms-max']))
+
+    def _enque_to_rmq(self, exchange, routing_key, data, properties=None):
+        if self.publishers is not None and threading.current_thread() is not self.channel_thread:
+            if self.publish_direct(exchange, routing_key, data, properties):
+                return
+        self.to_rmq.append({'exchange': exchange, 'routing-key': routing_key, 'data': data, 'properties': properties,
+                            'enqueued': get_time_millis()})
+        self.request_wakeup()
+
+    def publish_direct(self, exchange, routing_key, data, properties=None):
+        """
+        Publish on the calling thread's own connection, returns False when the thread has none and
+        the message has to be enqueued.  A thread either has a connection for good or enqueues
+        everything, so its own messages stay in order.  A failed connection is reopened once.
+        """
+        for attempt in range(2):
+            try:
+                publisher = self.publishers.publisher()
+            except Exception as e:
+                print('WARN: ', 'could not open a publisher connection', e.__class__.__name__ + ": " + str(e))
+                self.publishers.give_up()
+                return False
+            if publisher is None:
+                return False        # The pool was taken by other threads
+            now = get_time_millis()
+            try:
+                publisher.publish(exchange, routing_key, data, properties)
+            except (pika.exceptions.NackError, pika.exceptions.UnroutableError) as e:
+                with self.stats_lock:
+                    self.publish_stats['nacked'] += 1
+                print('WARN: ', 'broker did not confirm message to', routing_key, e.__class__.__name__)
+            except pika.exceptions.AMQPError as e:
+                print('WARN: ', 'publisher connection failed', e.__class__.__name__)
+                self.publishers.discard()
+                continue
+            self.metrics.inc('plant_direct_published_total')
+            self.record_publish(0.0, get_time_millis() - now)
+            return True
+        print('WARN: ', 'publishing through the consumer thread from now on')
+        self.publishers.give_up()
+        return False
 
     def __basic_publish(self, exchange, routing_key, data, properties=None):
         th = threading.current_thread()
@@ -216,7 +424,10 @@ class Plant:
             print( 'current thread', th.ident, th.name)
             print( 'channel thread', self.channel_thread.ident, self.channel_thread.name)
 
-        if properties is None:
-            self.channel.basic_publish(exchange, routing_key, data)
-        else:
-            self.channel.basic_publish(exchange, routing_key, data, properties)
+        try:
+            self.transport.publish(exchange, routing_key, data, properties)
+        except (pika.exceptions.NackError, pika.exceptions.UnroutableError) as e:
+            # Only raised when publisher confirms are on
+            with self.stats_lock:
+                self.publish_stats['nacked'] += 1
+            print('WARN: ', 'broker did not confirm message to', routing_key, e.__class__.__name__)
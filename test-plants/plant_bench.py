@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Dynamic Object Language Labs Inc.
+#
+# This software is licensed under the terms of the
+# Apache License, Version 2.0 which can be found in
+# the file LICENSE at the root of this distribution.
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from pprint import pprint
+
+import numpy as np
+
+import plant
+import frames
+import transport
+
+'''
+Latency and throughput benchmark for the gym plant protocol
+
+Drives make_env / reset / perform-action (or perform-actions with k steps
+per call) against a gym plant, for each environment, encoding and
+steps-per-call combination, and reports:
+
+    steps/sec            environment steps per wall clock second
+    latency              send -> started / observations / finished, p50 and p99 ms
+    bytes                observation bytes received per call
+    messages             messages received per call, observations, started and finished
+    serialize            time to re-encode the received observation payload, p50 us
+    publish              plant side queue and publish ms (loopback only)
+    startup              seconds for a fresh interpreter to import gym_plant, with --startup
+
+By default the plant runs in this process on the loopback transport, which
+measures plant overhead without network hops; --broker drives a plant
+running elsewhere through RabbitMQ.  Results are written as JSON and can be
+compared with an earlier run with --compare.
+'''
+
+
+def percentiles(values):
+    if not values:
+        return {'p50': None, 'p99': None}
+    return {'p50': float(np.percentile(values, 50)), 'p99': float(np.percentile(values, 99))}
+
+
+class PlantDriver:
+    """
+    Learner-side stand-in that issues blocking plant calls and times the replies
+    """
+
+    def __init__(self, exchange, routing_key, plant_id='gym', host='localhost', port=5672,
+                 msg_transport=None, timeout=10.0):
+        self.exchange = exchange
+        self.routing_key = routing_key     # where the plant listens for commands
+        self.plant_id = plant_id
+        self.timeout = timeout
+        self.plant = plant.Plant(None, exchange, host, port, msg_transport=msg_transport)
+        self.plant.subscribe(['observations', '#.frames'])
+        self.plant.transport.consume(self.plant.qname, self.on_message)
+        self.call_id = None
+        self.marks = {}
+        self.reason = None
+        self.received = []              # (routing key, body) of observations for the current call
+        self.messages = 0               # messages received for the current call
+        self.steps = 0                  # env steps the observations of the current call report
+        self.done = False               # the last step ended the episode
+
+    def on_message(self, channel, method, properties, body):
+        now = time.perf_counter()
+        if method.routing_key.endswith('.frames'):
+            self.marks.setdefault('observations', now)
+            self.received.append((method.routing_key, body))
+            self.messages += 1
+            frame = frames.decode(body)
+            self.steps += len(frame['states'])
+            self.done = bool(frame['dones'][-1] or frame['truncateds'][-1])
+            return
+        msg = plant.to_object(body)
+        if msg.get('plant-id') != self.plant_id:
+            return
+        if msg.get('state') == 'observations':
+            self.marks.setdefault('observations', now)
+            self.received.append((method.routing_key, body))
+            self.messages += 1
+            steps = 1                   # perform-actions adds the states of every step it took
+            for obs in msg['observations']:
+                if obs['field'] == 'done':
+                    self.done = bool(obs['value'])
+                elif obs['field'] == 'states':
+                    steps = len(obs['value'])
+            self.steps += steps
+            finished = msg.get('finished')      # delta mode finishes the call in the observations message
+            if finished is not None and finished['id'] == self.call_id:
+                self.marks['finished'] = now
+                self.reason = finished['reason']
+        elif msg.get('id') == self.call_id:
+            self.messages += 1
+            self.marks[msg['state']] = now
+            if msg['state'] == 'finished':
+                self.reason = msg.get('reason')
+
+    def call(self, fn_name, args):
+        self.call_id = plant.make_id('bench-')
+        self.marks = {}
+        self.reason = None
+        self.received = []
+        self.messages = 0
+        self.steps = 0
+        msg = {'id': self.call_id, 'plant-id': self.plant_id, 'function-name': fn_name, 'args': args}
+        t0 = time.perf_counter()
+        self.plant._enque_to_rmq(self.exchange, self.routing_key, json.dumps(msg))
+        while 'finished' not in self.marks:
+            if time.perf_counter() - t0 > self.timeout:
+                raise TimeoutError(fn_name + ' did not finish within ' + str(self.timeout) + 's')
+            self.plant.transport.process_data_events(0.1)
+        if self.reason is None or self.reason.get('finish-state') != 'success':
+            raise RuntimeError(fn_name + ' failed: ' + str(self.reason))
+        return dict((k, (v - t0) * 1000.0) for k, v in self.marks.items())
+
+    def settle(self, seconds=0.2):
+        # Observations published after finished (make_env) must not leak into the next call
+        t0 = time.perf_counter()
+        while time.perf_counter() - t0 < seconds:
+            self.plant.transport.process_data_events(0.01)
+
+    def close(self):
+        self.plant.close()
+
+
+def serialize_us(routing_key, body, encoder):
+    # Re-encode a received payload the way the plant encodes it
+    if routing_key.endswith('.frames'):
+        frame = frames.decode(body)
+        t0 = time.perf_counter()
+        encoder.encode(frame['kind'], frame['states'], frame['rewards'], frame['flags'], frame['timestamp'])
+    else:
+        msg = json.loads(body)
+        t0 = time.perf_counter()
+        json.dumps(msg)
+    return (time.perf_counter() - t0) * 1e6
+
+
+def start_loopback_plant(exchange, plantid, observation_mode='full'):
+    """
+    Run a gym plant on the loopback transport in a thread of this process.
+    """
+    import gym_plant
+    broker = transport.LoopbackBroker()
+    ready = threading.Event()
+    holder = {}
+
+    def run():
+        holder['rmq'] = gym_plant.Rmq(plantid, exchange, 'loopback', 0, observation_mode=observation_mode,
+                                      msg_transport=transport.LoopbackTransport(broker))
+        ready.set()
+        holder['rmq'].subscribe_and_wait()
+
+    threading.Thread(target=run, name='gym-plant', daemon=True).start()
+    ready.wait()
+    return broker, holder['rmq']
+
+
+def run_case(driver, rmq, envname, encoding, steps_per_call, calls, episode_steps):
+    driver.call('make_env', [envname, 0, encoding])
+    driver.settle()
+    driver.call('reset', [])
+    encoder = None
+    if encoding != 'json':
+        num_obs = frames.decode(driver.received[-1][1])['states'].shape[1]
+        encoder = frames.FrameEncoder(encoding, num_obs)
+    if rmq is not None:
+        for k in rmq.plant.publish_stats:
+            rmq.plant.publish_stats[k] = 0
+
+    latency = {'started': [], 'observations': [], 'finished': []}
+    payloads = []
+    nbytes = 0
+    messages = 0
+    steps = 0
+    episode = 0
+    t0 = time.perf_counter()
+    for i in range(calls):
+        action = i % 2
+        if steps_per_call == 1:
+            marks = driver.call('perform-action', [action])
+        else:
+            marks = driver.call('perform-actions', [action, steps_per_call])
+        for k in latency:
+            if k in marks:
+                latency[k].append(marks[k])
+        for rk, body in driver.received:
+            nbytes += len(body)
+        messages += driver.messages
+        payloads.extend(driver.received)
+        # perform-actions stops at the end of an episode, count the steps taken, not asked for
+        steps += driver.steps
+        episode += driver.steps
+        if driver.done or episode >= episode_steps:
+            driver.call('reset', [])
+            driver.done = False
+            episode = 0
+    seconds = time.perf_counter() - t0
+    serialize = [serialize_us(rk, body, encoder) for rk, body in payloads]
+
+    result = {'env': envname,
+              'encoding': encoding,
+              'steps-per-call': steps_per_call,
+              'calls': calls,
+              'steps': steps,
+              'seconds': seconds,
+              'steps-per-sec': steps / seconds,
+              'calls-per-sec': calls / seconds,
+              'bytes-per-call': nbytes / calls,
+              'messages-per-call': messages / calls,
+              'latency-ms': dict((k, percentiles(v)) for k, v in latency.items()),
+              'serialize-us': percentiles(serialize)}
+    if rmq is not None:
+        stats = rmq.plant.publish_stats
+        n = max(stats['published'], 1)
+        result['publish-ms-avg'] = stats['publish-ms-total'] / n
+        result['queue-ms-avg'] = stats['queue-ms-total'] / n
+    return result
+
+
+def measure_startup(runs):
+    """
+    Wall clock seconds of fresh interpreters importing gym_plant, the cold start cost of a plant.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    seconds = []
+    for i in range(runs):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import gym_plant'], cwd=here, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        seconds.append(time.perf_counter() - t0)
+    return percentiles(seconds)
+
+
+def case_key(result):
+    return (result['env'], result['encoding'], result['steps-per-call'])
+
+
+def compare(results, startup, baseline_file):
+    with open(baseline_file) as f:
+        report = json.load(f)
+    baseline = dict((case_key(r), r) for r in report['results'])
+    if startup is not None and report.get('startup') is not None:
+        print('startup p50 %.3f s, baseline %.3f s, ratio %.2f' %
+              (startup['p50'], report['startup']['p50'], startup['p50'] / report['startup']['p50']))
+    print('%-20s %-8s %5s %12s %12s %8s' % ('env', 'encoding', 'k', 'steps/sec', 'baseline', 'ratio'))
+    for r in results:
+        b = baseline.get(case_key(r))
+        if b is None:
+            continue
+        print('%-20s %-8s %5d %12.1f %12.1f %8.2f' % (r['env'], r['encoding'], r['steps-per-call'],
+                                                     r['steps-per-sec'], b['steps-per-sec'],
+                                                     r['steps-per-sec'] / b['steps-per-sec']))
+
+
+def main(args):
+    startup = None
+    if args.startup > 0:
+        startup = measure_startup(args.startup)
+        print('startup: import gym_plant p50 %.3f s p99 %.3f s' % (startup['p50'], startup['p99']))
+    rmq = None
+    if args.broker:
+        msg_transport = None
+    else:
+        broker, rmq = start_loopback_plant(args.exchange, args.plantid, args.observation_mode)
+        msg_transport = transport.LoopbackTransport(broker)
+    driver = PlantDriver(args.exchange, args.plantid, 'gym', args.host, args.port, msg_transport, args.timeout)
+
+    results = []
+    for envname in args.envs.split(','):
+        for encoding in args.encodings.split(','):
+            for k in [int(k) for k in args.steps_per_call.split(',')]:
+                result = run_case(driver, rmq, envname, encoding, k, args.calls, args.episode_steps)
+                print('%-20s %-8s k=%-4d %10.1f steps/sec  finished p50 %.3f ms p99 %.3f ms  %.0f bytes/call'
+                      '  %.2f messages/call' %
+                      (envname, encoding, k, result['steps-per-sec'],
+                       result['latency-ms']['finished']['p50'], result['latency-ms']['finished']['p99'],
+                       result['bytes-per-call'], result['messages-per-call']))
+                results.append(result)
+    driver.close()
+
+    report = {'version': 1,
+              'timestamp': plant.get_time_millis(),
+              'transport': 'rabbitmq' if args.broker else 'loopback',
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'startup': startup,
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('results written to', args.output)
+    if args.compare:
+        compare(results, startup, args.compare)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Gym Plant benchmark')
+    parser.add_argument('--broker', action='store_true',
+                        help='drive a plant through RabbitMQ instead of an in-process loopback plant')
+    parser.add_argument('--host', default='localhost', help='RMQ host')
+    parser.add_argument('-p', '--port', default=5672, help='RMQ Port', type=int)
+    parser.add_argument('-e', '--exchange', default='dmrl', help='RMQ Exchange')
+    parser.add_argument('--plantid', default="dmrl", help='routing key the plant listens on')
+    parser.add_argument('--envs', default='CartPole-v1,MountainCar-v0,Acrobot-v1', help='comma separated gym envs')
+    parser.add_argument('--encodings', default='json,float32', help='comma separated observation encodings')
+    parser.add_argument('--steps-per-call', default='1,8,32',
+                        help='comma separated steps per call, more than 1 uses perform-actions')
+    parser.add_argument('--calls', default=500, type=int, help='plant calls per case')
+    parser.add_argument('--episode-steps', default=200, type=int, help='reset at least this often')
+    parser.add_argument('--observation-mode', default='full', choices=['full', 'delta'],
+                        help='observation mode of the loopback plant')
+    parser.add_argument('--timeout', default=10.0, type=float, help='seconds to wait for a call to finish')
+    parser.add_argument('--startup', default=0, type=int,
+                        help='also time this many cold imports of gym_plant in fresh interpreters')
+    parser.add_argument('-o', '--output', default=None, help='write results as JSON to this file')
+    parser.add_argument('--compare', default=None, help='compare steps/sec with a previous JSON results file')
+
+    args = parser.parse_args()
+    pprint(args)
+    main(args)
+    sys.exit(0)
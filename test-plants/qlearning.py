@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Dynamic Object Language Labs Inc.
+#
+# This software is licensed under the terms of the
+# Apache License, Version 2.0 which can be found in
+# the file LICENSE at the root of this distribution.
+
+import base64
+import json
+import struct
+import numpy as np
+
+'''
+Plant-side tabular Q-learning
+
+Runs whole training episodes inside the plant with the same algorithm as
+the Clojure learner (DMQL/run-episode with the textbook epsilon-greedy
+selector, mode 0), so that bulk training is not bounded by one broker
+round trip per step.  The plant runs it in a pool process on an env of
+its own, train_in_process, so it keeps serving while a run goes on.  The Q-table has the learner's java-fixed-sized
+layout: discretization cells per state variable followed by the actions,
+as float32.
+
+The result is one binary message:
+
+    header   magic 'DMRQ', version, length of the JSON description
+    JSON     description: id, plant-id, q-shape, episodes run, ...
+    q-table  float32, C order
+    stats    per episode: reward float64, steps int32, succeeded uint8, epsilon float64
+'''
+
+MAGIC = b'DMRQ'
+VERSION = 1
+HEADER = struct.Struct('<4sBxxxI')
+
+
+def discretize(state, obslow, win_size, discretization):
+    # As GYMinterface/get-discrete-state, truncate then clamp to the table
+    cells = ((np.asarray(state, dtype=np.float64) - obslow) / win_size).astype(np.int64)
+    return tuple(np.clip(cells, 0, discretization - 1))
+
+
+def epsilon_schedule(epsilon, explore, episodes):
+    """
+    Epsilon of every episode, decaying linearly to 0 over the first explore fraction, as DMQL/train.
+    """
+    end_decay = int(episodes * explore)
+    decay_by = epsilon / max(end_decay - 1, 1)
+    eps = epsilon - np.arange(episodes) * decay_by
+    eps[np.arange(episodes) > end_decay] = 0.0
+    return eps
+
+
+def decode_q_table(value, shape):
+    # The table is either a nested list or base64 of little-endian float32 in C order
+    if isinstance(value, str):
+        return np.frombuffer(base64.b64decode(value), dtype='<f4').reshape(shape).copy()
+    q = np.asarray(value, dtype=np.float32)
+    if q.shape != tuple(shape):
+        raise ValueError('q-table has shape ' + str(q.shape) + ', expected ' + str(tuple(shape)))
+    return q
+
+
+def make_q_table(params, shape, rng):
+    if params.get('q-table') is not None:
+        return decode_q_table(params['q-table'], shape)
+    if params.get('q-init') is not None:
+        low, high = params['q-init']
+        return rng.uniform(low, high, size=shape).astype(np.float32)
+    return np.full(shape, -1.0, dtype=np.float32)
+
+
+def goal_achieved(env, state, reward, done):
+    # GYMinterface/goal-achieved-MountainCar-V0 and goal-achieved-generic
+    goal_position = getattr(env.unwrapped, 'goal_position', None)
+    if goal_position is not None:
+        return state[0] > goal_position
+    return done and reward >= 0
+
+
+# Hyperparameters train_episodes needs, and how they are read
+TRAINING_PARAMS = [('discretization', int), ('alpha', float), ('gamma', float), ('max-steps', int),
+                   ('num-episodes', int), ('epsilon', float), ('explore', float)]
+
+
+def check_training_params(params):
+    """
+    Raises KeyError, ValueError or TypeError for a missing or malformed hyperparameter.
+    """
+    for name, kind in TRAINING_PARAMS:
+        kind(params[name])
+    if int(params['discretization']) < 1:
+        raise ValueError('discretization must be at least 1')
+
+
+def train_in_process(envname, env_kwargs, q, obslow, win_size, params, rng):
+    """
+    train_episodes on an env of its own, run in a pool process so the plant keeps serving.
+    Returns the trained q with the per-episode stats.
+    """
+    import gymnasium as gym
+    env = gym.make(envname, **(env_kwargs or {}))
+    try:
+        return (q,) + train_episodes(env, q, obslow, win_size, params, rng)
+    finally:
+        env.close()
+
+
+def train_episodes(env, q, obslow, win_size, params, rng):
+    """
+    Train params['num-episodes'] episodes on env, updating q in place.
+    Returns per-episode (rewards, steps, succeeded, epsilons).
+    """
+    discretization = int(params['discretization'])
+    alpha = float(params['alpha'])
+    gamma = float(params['gamma'])
+    max_steps = int(params['max-steps'])
+    start = int(params.get('start-episode', 0))
+    num_episodes = int(params['num-episodes'])
+    total_episodes = int(params.get('episodes', start + num_episodes))
+    numacts = q.shape[-1]
+    schedule = epsilon_schedule(float(params['epsilon']), float(params['explore']), max(total_episodes, start + num_episodes))
+
+    rewards = np.zeros(num_episodes, dtype=np.float64)
+    steps = np.zeros(num_episodes, dtype=np.int32)
+    succeeded = np.zeros(num_episodes, dtype=np.uint8)
+    epsilons = schedule[start:start + num_episodes]
+
+    for i in range(num_episodes):
+        eps = epsilons[i]
+        state, _ = env.reset(seed=int(rng.integers(2**31)))
+        ds = discretize(state, obslow, win_size, discretization)
+        done = False
+        step = 0
+        ereward = 0.0
+        while not done and step < max_steps:
+            if rng.random() > eps:
+                action = int(np.argmax(q[ds]))
+            else:
+                action = int(rng.integers(numacts))
+            state, reward, done, truncated, _ = env.step(action)
+            new_ds = discretize(state, obslow, win_size, discretization)
+            if not done and step < max_steps:
+                # Bellman's equation
+                q[ds + (action,)] = (1.0 - alpha) * q[ds + (action,)] + alpha * (reward + gamma * np.max(q[new_ds]))
+            elif goal_achieved(env, state, reward, done):
+                q[new_ds + (action,)] = 0.0
+            if done and goal_achieved(env, state, reward, done):
+                succeeded[i] = 1
+            ereward += reward
+            step += 1
+            ds = new_ds
+            done = done or truncated
+        rewards[i] = ereward
+        steps[i] = step
+    return rewards, steps, succeeded, epsilons
+
+
+def encode_result(description, q, rewards, steps, succeeded, epsilons):
+    description = dict(description)
+    description['q-shape'] = list(q.shape)
+    description['num-episodes'] = len(rewards)
+    text = json.dumps(description).encode('utf-8')
+    return b''.join([HEADER.pack(MAGIC, VERSION, len(text)), text,
+                     np.ascontiguousarray(q, dtype='<f4').tobytes(),
+                     np.asarray(rewards, dtype='<f8').tobytes(),
+                     np.asarray(steps, dtype='<i4').tobytes(),
+                     np.asarray(succeeded, dtype=np.uint8).tobytes(),
+                     np.asarray(epsilons, dtype='<f8').tobytes()])
+
+
+def decode_result(data):
+    magic, version, length = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a version ' + str(VERSION) + ' Q-table message')
+    offset = HEADER.size
+    description = json.loads(data[offset:offset + length].decode('utf-8'))
+    offset += length
+    result = {'description': description}
+    n = description['num-episodes']
+    for name, dtype, count in [('q-table', '<f4', int(np.prod(description['q-shape']))),
+                               ('rewards', '<f8', n), ('steps', '<i4', n),
+                               ('succeeded', np.uint8, n), ('epsilons', '<f8', n)]:
+        result[name] = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+        offset += result[name].nbytes
+    result['q-table'] = result['q-table'].reshape(description['q-shape'])
+    return result
+
+
+# Policy evaluation.  evaluate_seeds runs in pool processes, so it builds its own env.
+
+def greedy_episode(env, q, obslow, win_size, discretization, max_steps, seed):
+    state, _ = env.reset(seed=seed)
+    total = 0.0
+    step = 0
+    done = False
+    reward = 0.0
+    while step < max_steps:
+        action = int(np.argmax(q[discretize(state, obslow, win_size, discretization)]))
+        state, reward, done, truncated, _ = env.step(action)
+        total += reward
+        step += 1
+        if done or truncated:
+            break
+    return total, step, bool(done and goal_achieved(env, state, reward, done))
+
+
+def evaluate_seeds(envname, env_kwargs, q, obslow, win_size, discretization, max_steps, seeds, goal_position=None):
+    import gymnasium as gym
+    env = gym.make(envname, **(env_kwargs or {}))
+    if goal_position is not None:
+        env.unwrapped.goal_position = goal_position
+    try:
+        return [greedy_episode(env, q, obslow, win_size, discretization, max_steps, seed) for seed in seeds]
+    finally:
+        env.close()
+
+
+def summarize_evaluation(results):
+    returns = np.array([r[0] for r in results], dtype=np.float64)
+    lengths = np.array([r[1] for r in results], dtype=np.int64)
+    successes = np.array([r[2] for r in results], dtype=bool)
+    if len(results) == 0:
+        return {'episodes': 0}
+    return {'episodes': len(results),
+            'mean-return': float(returns.mean()),
+            'std-return': float(returns.std()),
+            'success-rate': float(successes.mean()),
+            'mean-length': float(lengths.mean()),
+            'min-length': int(lengths.min()),
+            'max-length': int(lengths.max()),
+            'returns': returns.tolist(),
+            'lengths': lengths.tolist()}
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Dynamic Object Language Labs Inc.
+#
+# This software is licensed under the terms of the
+# Apache License, Version 2.0 which can be found in
+# the file LICENSE at the root of this distribution.
+
+import struct
+import numpy as np
+from multiprocessing import shared_memory
+
+'''
+Shared memory ring buffer for large array payloads
+
+Pixel observations and rgb_array renders are too big to push through
+RabbitMQ at frame rate.  The plant writes them into a ring of fixed size
+slots in host shared memory and publishes only a descriptor:
+
+    {'shm': name, 'slot': k, 'offset': bytes, 'shape': [...], 'dtype': 'uint8', 'seq': n}
+
+A consumer on the same host attaches to the segment by name and gets a
+numpy view of the slot without copying.  A slot is reused every 'slots'
+frames, so a consumer that holds on to a view checks valid() before
+trusting it, or copies it.
+
+Each slot starts with a 64 byte header holding the sequence number of the
+frame in it, 0 while the slot is being written, and the frame size.
+'''
+
+SLOT_HEADER = struct.Struct('<QQ')     # seq, nbytes
+HEADER_BYTES = 64
+ALIGN = 64
+
+
+def round_up(n, align=ALIGN):
+    return (n + align - 1) // align * align
+
+
+def attach(name):
+    # Attaching must not register the segment for cleanup at our exit, the writer owns it
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class FrameRing:
+    """
+    Writer side, owned by the plant.  The segment is sized for slot_bytes frames;
+    write() moves to a new, larger segment when a frame does not fit.
+    """
+
+    def __init__(self, name, slots=8):
+        self.name = name
+        self.slots = slots
+        self.generation = 0
+        self.shm = None
+        self.slot_bytes = 0
+        self.stride = 0
+        self.seq = 0
+
+    def allocate(self, nbytes):
+        self.close()
+        self.generation += 1
+        self.slot_bytes = round_up(nbytes)
+        self.stride = HEADER_BYTES + self.slot_bytes
+        self.shm = shared_memory.SharedMemory(name=self.name + '-' + str(self.generation), create=True,
+                                              size=self.stride * self.slots)
+        print('frame ring', self.shm.name, self.slots, 'slots of', self.slot_bytes, 'bytes')
+
+    def write(self, array):
+        """
+        Copy array into the next slot and return its descriptor.
+        """
+        array = np.ascontiguousarray(array)
+        if self.shm is None or array.nbytes > self.slot_bytes:
+            self.allocate(array.nbytes)
+        self.seq += 1
+        base = (self.seq % self.slots) * self.stride
+        buf = self.shm.buf
+        SLOT_HEADER.pack_into(buf, base, 0, array.nbytes)
+        offset = base + HEADER_BYTES
+        np.ndarray(array.shape, array.dtype, buffer=buf, offset=offset)[...] = array
+        SLOT_HEADER.pack_into(buf, base, self.seq, array.nbytes)
+        return {'shm': self.shm.name, 'slot': self.seq % self.slots, 'offset': offset,
+                'shape': list(array.shape), 'dtype': array.dtype.str, 'seq': self.seq}
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+class FrameReader:
+    """
+    Consumer side, attaches to the segments named in descriptors as they appear.
+    """
+
+    def __init__(self):
+        self.segments = {}          # shm name -> SharedMemory
+
+    def segment(self, name):
+        shm = self.segments.get(name)
+        if shm is None:
+            shm = self.segments[name] = attach(name)
+        return shm
+
+    def view(self, descriptor):
+        """
+        Zero-copy numpy view of the frame, or None when the slot was already reused.
+        """
+        if not self.valid(descriptor):
+            return None
+        shm = self.segment(descriptor['shm'])
+        return np.ndarray(descriptor['shape'], np.dtype(descriptor['dtype']), buffer=shm.buf,
+                          offset=descriptor['offset'])
+
+    def valid(self, descriptor):
+        shm = self.segment(descriptor['shm'])
+        seq, nbytes = SLOT_HEADER.unpack_from(shm.buf, descriptor['offset'] - HEADER_BYTES)
+        return seq == descriptor['seq']
+
+    def close(self):
+        for shm in self.segments.values():
+            shm.close()
+        self.segments = {}
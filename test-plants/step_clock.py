@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Dynamic Object Language Labs Inc.
+#
+# This software is licensed under the terms of the
+# Apache License, Version 2.0 which can be found in
+# the file LICENSE at the root of this distribution.
+
+import time
+import numpy as np
+
+'''
+Fixed rate tick scheduler
+
+StepClock calls on_tick(tick, late) every 1/rate seconds through a
+call_later(delay, callback) function, such as Plant.call_later, so ticks
+run on the connection thread between message deliveries.  Deadlines are
+absolute, start + n * period, so lateness does not accumulate into drift.
+A tick that ends after the next deadline is an overrun; the deadlines it
+made the clock miss are skipped rather than run back to back.
+'''
+
+
+class StepClock:
+    def __init__(self, rate, call_later, on_tick, jitter_window=1024):
+        self.period = 1.0 / rate
+        self.call_later = call_later
+        self.on_tick = on_tick
+        self.running = False
+        self.ticks = 0
+        self.overruns = 0
+        self.missed = 0
+        self.started = None
+        self.next_due = None
+        self.late = np.zeros(jitter_window)     # ring of the latest tick lateness, seconds
+        self.work_total = 0.0
+        self.work_max = 0.0
+
+    def start(self):
+        self.running = True
+        self.started = time.perf_counter()
+        self.next_due = self.started + self.period
+        self.schedule()
+
+    def stop(self):
+        self.running = False
+
+    def schedule(self):
+        self.call_later(max(0.0, self.next_due - time.perf_counter()), self.fire)
+
+    def fire(self):
+        if not self.running:
+            return
+        now = time.perf_counter()
+        late = now - self.next_due
+        self.late[self.ticks % len(self.late)] = late
+        self.on_tick(self.ticks, late)
+        self.ticks += 1
+        done = time.perf_counter()
+        self.work_total += done - now
+        self.work_max = max(self.work_max, done - now)
+        self.next_due += self.period
+        if done > self.next_due:
+            missed = int((done - self.next_due) // self.period) + 1
+            self.overruns += 1
+            self.missed += missed
+            self.next_due += missed * self.period
+        if self.running:
+            self.schedule()
+
+    def stats(self):
+        late = np.abs(self.late[:min(self.ticks, len(self.late))]) * 1000.0
+        elapsed = time.perf_counter() - self.started if self.started is not None else 0.0
+        return {'rate': 1.0 / self.period,
+                'achieved-rate': self.ticks / elapsed if elapsed > 0 else 0.0,
+                'ticks': self.ticks,
+                'overruns': self.overruns,
+                'missed-ticks': self.missed,
+                'jitter-ms': {'mean': float(late.mean()) if len(late) else None,
+                              'p99': float(np.percentile(late, 99)) if len(late) else None,
+                              'max': float(late.max()) if len(late) else None},
+                'tick-ms': {'mean': self.work_total * 1000.0 / max(self.ticks, 1),
+                            'max': self.work_max * 1000.0}}
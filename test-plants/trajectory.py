@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Dynamic Object Language Labs Inc.
+#
+# This software is licensed under the terms of the
+# Apache License, Version 2.0 which can be found in
+# the file LICENSE at the root of this distribution.
+
+import json
+import os
+import numpy as np
+
+'''
+Memory-mapped trajectory recordings
+
+A recording is a directory holding one append-only file per column and a
+meta.json with the environment description and the number of rows in
+each column:
+
+    episode-starts  int64          first transition of each episode
+    states          obs dtype      state before the action, num-obs wide
+    actions         int32
+    rewards         float64
+    next-states     obs dtype      state after the action
+    dones           uint8          terminated
+    truncateds      uint8
+
+Columns are numpy memmaps grown by doubling, so appending a transition
+is a handful of array stores.  meta.json is rewritten at every episode
+start and at close, and only rows it counts are read back, so a reader
+never sees a partly written transition.  TrajectoryReader maps the
+columns read-only, which makes replaying large recordings cheap.
+'''
+
+META = 'meta.json'
+
+
+class Column:
+    def __init__(self, path, dtype, width=None, length=0, mode='w+', capacity=1024):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.row_shape = () if width is None else (width,)
+        self.length = length
+        if mode == 'r':
+            self.capacity = length
+            self.data = np.memmap(path, self.dtype, 'r', shape=(length,) + self.row_shape) if length > 0 else \
+                np.zeros((0,) + self.row_shape, self.dtype)
+        else:
+            open(path, 'wb').close()
+            self.capacity = 0
+            self.data = None
+            self.grow(capacity)
+
+    def grow(self, capacity):
+        if self.data is not None:
+            self.data.flush()
+            del self.data
+        row_bytes = self.dtype.itemsize * int(np.prod(self.row_shape))
+        with open(self.path, 'ab') as f:
+            f.truncate(capacity * row_bytes)
+        self.capacity = capacity
+        self.data = np.memmap(self.path, self.dtype, 'r+', shape=(capacity,) + self.row_shape)
+
+    def append(self, value):
+        if self.length == self.capacity:
+            self.grow(self.capacity * 2)
+        self.data[self.length] = value
+        self.length += 1
+
+    def __getitem__(self, index):
+        return self.data[:self.length][index]
+
+    def close(self):
+        # Drop the unused capacity, leaving exactly length rows on disk
+        self.data.flush()
+        del self.data
+        self.data = None
+        row_bytes = self.dtype.itemsize * int(np.prod(self.row_shape))
+        with open(self.path, 'r+b') as f:
+            f.truncate(self.length * row_bytes)
+
+
+def column_specs(num_obs, obs_dtype):
+    return [('episode-starts', 'int64', None),
+            ('states', obs_dtype, num_obs),
+            ('actions', 'int32', None),
+            ('rewards', 'float64', None),
+            ('next-states', obs_dtype, num_obs),
+            ('dones', 'uint8', None),
+            ('truncateds', 'uint8', None)]
+
+
+class TrajectoryRecorder:
+    def __init__(self, path, envname, observation_space, action_space):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.meta = {'version': 1,
+                     'env': envname,
+                     'num-obs': int(observation_space.shape[0]),
+                     'num-acts': int(action_space.n),
+                     'obs-dtype': str(observation_space.dtype),
+                     'high': [float(x) for x in observation_space.high],
+                     'low': [float(x) for x in observation_space.low]}
+        self.columns = dict((name, Column(os.path.join(path, name), dtype, width))
+                            for name, dtype, width in column_specs(self.meta['num-obs'], self.meta['obs-dtype']))
+        self.state = None
+        self.write_meta()
+
+    def begin_episode(self, state):
+        self.write_meta()
+        self.columns['episode-starts'].append(self.columns['actions'].length)
+        self.state = state
+
+    def record(self, action, reward, next_state, done, truncated):
+        if self.state is None:
+            return                  # Stepping before the first reset, there is no episode to add to
+        c = self.columns
+        c['states'].append(self.state)
+        c['actions'].append(action)
+        c['rewards'].append(reward)
+        c['next-states'].append(next_state)
+        c['dones'].append(done)
+        c['truncateds'].append(truncated)
+        self.state = next_state
+
+    def write_meta(self):
+        meta = dict(self.meta)
+        meta['lengths'] = dict((name, c.length) for name, c in self.columns.items())
+        tmp = os.path.join(self.path, META + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp, os.path.join(self.path, META))
+
+    def close(self):
+        self.write_meta()
+        for c in self.columns.values():
+            c.close()
+        print('recorded', self.columns['actions'].length, 'transitions in',
+              self.columns['episode-starts'].length, 'episodes to', self.path)
+
+
+class TrajectoryReader:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META)) as f:
+            self.meta = json.load(f)
+        lengths = self.meta['lengths']
+        self.columns = {}
+        for name, dtype, width in column_specs(self.meta['num-obs'], self.meta['obs-dtype']):
+            self.columns[name] = Column(os.path.join(path, name), dtype, width, lengths[name], mode='r')
+        # Episodes whose start was recorded before meta.json was last written
+        self.starts = np.asarray(self.columns['episode-starts'][:], dtype=np.int64)
+        self.num_transitions = lengths['actions']
+
+    def num_episodes(self):
+        return len(self.starts)
+
+    def episode_range(self, episode):
+        start = int(self.starts[episode])
+        end = int(self.starts[episode + 1]) if episode + 1 < len(self.starts) else self.num_transitions
+        return start, end
+
+    def column(self, name):
+        return self.columns[name]
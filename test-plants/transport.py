@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Dynamic Object Language Labs Inc.
+#
+# This software is licensed under the terms of the
+# Apache License, Version 2.0 which can be found in
+# the file LICENSE at the root of this distribution.
+
+import time
+import heapq
+import threading
+import collections
+import types
+import weakref
+import pika
+
+'''
+Message transports for plant.Plant
+
+A transport is the connection and channel under a Plant: it declares the
+topic exchange and the plant's queue, binds routing keys, consumes and
+acks, publishes, and runs callbacks on the consuming thread.
+
+PikaTransport is the RabbitMQ backend.  LoopbackTransport connects to an
+in-process LoopbackBroker that routes by topic exchange binding, so that
+plants and learner-side drivers can run in one process without a broker.
+
+A transport is used from one thread.  PublisherPool gives other threads
+publish-only transports of their own, opened with open_publisher().
+Nothing services a publisher's connection while its thread is idle, so
+publisher connections are opened without heartbeats.
+'''
+
+
+class PikaTransport:
+    def __init__(self, host='localhost', port=5672, heartbeat=None):
+        self.host = host
+        self.port = port
+        # heartbeat None takes the broker's, 0 turns heartbeats off
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host, port, heartbeat=heartbeat))
+        self.channel = self.connection.channel()
+
+    def open_publisher(self):
+        # pika connections are not thread safe, so another thread needs a connection of its own.
+        # No heartbeats: the connection is only serviced when its thread publishes.
+        return PikaTransport(self.host, self.port, heartbeat=0)
+
+    def declare_exchange(self, exchange):
+        self.channel.exchange_declare(exchange=exchange, exchange_type='topic')
+
+    def declare_queue(self):
+        return self.channel.queue_declare('', exclusive=True).method.queue
+
+    def bind(self, qname, exchange, routing_key):
+        self.channel.queue_bind(queue=qname, exchange=exchange, routing_key=routing_key)
+
+    def set_prefetch(self, prefetch_count):
+        self.channel.basic_qos(prefetch_count=prefetch_count)
+
+    def enable_confirms(self):
+        self.channel.confirm_delivery()
+
+    def consume(self, qname, callback):
+        self.channel.basic_consume(qname, callback, auto_ack=False)
+
+    def start_consuming(self):
+        self.channel.start_consuming()
+
+    def process_data_events(self, time_limit=0):
+        self.connection.process_data_events(time_limit=time_limit)
+
+    def ack(self, delivery_tag, multiple=False):
+        self.channel.basic_ack(delivery_tag=delivery_tag, multiple=multiple)
+
+    def publish(self, exchange, routing_key, data, properties=None):
+        if properties is None:
+            self.channel.basic_publish(exchange, routing_key, data)
+        else:
+            self.channel.basic_publish(exchange, routing_key, data, properties)
+
+    def add_callback_threadsafe(self, callback):
+        self.connection.add_callback_threadsafe(callback)
+
+    def call_later(self, delay, callback):
+        self.connection.call_later(delay, callback)
+
+    def is_open(self):
+        return self.channel.is_open
+
+    def close(self):
+        self.channel.close()
+        self.connection.close()
+
+
+def topic_matches(pattern, routing_key):
+    """
+    RabbitMQ topic matching: '*' matches exactly one word, '#' zero or more words.
+    """
+    return _words_match(pattern.split('.'), routing_key.split('.'))
+
+
+def _words_match(pattern, words):
+    if not pattern:
+        return not words
+    if pattern[0] == '#':
+        return any(_words_match(pattern[1:], words[i:]) for i in range(len(words) + 1))
+    if not words:
+        return False
+    return (pattern[0] == '*' or pattern[0] == words[0]) and _words_match(pattern[1:], words[1:])
+
+
+class LoopbackBroker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.exchanges = {}         # exchange -> list of (binding key, queue name)
+        self.queues = {}            # queue name -> owning LoopbackTransport
+        self.queue_index = 0
+        self.routed = 0
+        self.dropped = 0
+
+    def declare_exchange(self, exchange):
+        with self.lock:
+            self.exchanges.setdefault(exchange, [])
+
+    def declare_queue(self, transport):
+        with self.lock:
+            self.queue_index += 1
+            qname = 'loopback.q-' + str(self.queue_index)
+            self.queues[qname] = transport
+            return qname
+
+    def delete_queue(self, qname):
+        with self.lock:
+            self.queues.pop(qname, None)
+            for bindings in self.exchanges.values():
+                bindings[:] = [b for b in bindings if b[1] != qname]
+
+    def bind(self, qname, exchange, routing_key):
+        with self.lock:
+            bindings = self.exchanges.setdefault(exchange, [])
+            if (routing_key, qname) not in bindings:
+                bindings.append((routing_key, qname))
+
+    def publish(self, exchange, routing_key, data, properties=None):
+        with self.lock:
+            # A queue bound with several matching keys still gets one copy
+            targets = []
+            for key, qname in self.exchanges.get(exchange, []):
+                if qname not in targets and topic_matches(key, routing_key):
+                    targets.append(qname)
+            transports = [(qname, self.queues[qname]) for qname in targets if qname in self.queues]
+            if transports:
+                self.routed += 1
+            else:
+                self.dropped += 1
+        for qname, transport in transports:
+            transport.deliver(qname, exchange, routing_key, data, properties)
+
+
+class LoopbackTransport:
+    def __init__(self, broker):
+        self.broker = broker
+        self.cond = threading.Condition()
+        self.queues = {}            # queue name -> deque of (exchange, routing key, data, properties)
+        self.consumers = {}         # queue name -> callback
+        self.callbacks = collections.deque()
+        self.timers = []            # heap of (due time, sequence, callback)
+        self.timer_index = 0
+        self.delivery_tag = 0
+        self.open = True
+
+    def open_publisher(self):
+        return LoopbackTransport(self.broker)
+
+    def declare_exchange(self, exchange):
+        self.broker.declare_exchange(exchange)
+
+    def declare_queue(self):
+        qname = self.broker.declare_queue(self)
+        with self.cond:
+            self.queues[qname] = collections.deque()
+        return qname
+
+    def bind(self, qname, exchange, routing_key):
+        self.broker.bind(qname, exchange, routing_key)
+
+    def set_prefetch(self, prefetch_count):
+        pass                        # Everything is delivered in-process
+
+    def enable_confirms(self):
+        pass                        # Publishing is synchronous
+
+    def consume(self, qname, callback):
+        with self.cond:
+            self.consumers[qname] = callback
+            self.cond.notify()
+
+    def ack(self, delivery_tag, multiple=False):
+        pass
+
+    def publish(self, exchange, routing_key, data, properties=None):
+        if isinstance(data, str):
+            data = data.encode('utf-8')     # As pika does, consumers always get bytes
+        self.broker.publish(exchange, routing_key, data, properties)
+
+    def deliver(self, qname, exchange, routing_key, data, properties):
+        with self.cond:
+            if qname in self.queues:
+                self.queues[qname].append((exchange, routing_key, data, properties))
+                self.cond.notify()
+
+    def add_callback_threadsafe(self, callback):
+        with self.cond:
+            self.callbacks.append(callback)
+            self.cond.notify()
+
+    def call_later(self, delay, callback):
+        with self.cond:
+            self.timer_index += 1
+            heapq.heappush(self.timers, (time.monotonic() + delay, self.timer_index, callback))
+            self.cond.notify()
+
+    def is_open(self):
+        return self.open
+
+    def close(self):
+        with self.cond:
+            self.open = False
+            self.cond.notify()
+        for qname in list(self.queues):
+            self.broker.delete_queue(qname)
+
+    def next_work(self):
+        # Called with cond held.  Threadsafe callbacks first, then due timers, then deliveries.
+        if self.callbacks:
+            return self.callbacks.popleft(), ()
+        if self.timers and self.timers[0][0] <= time.monotonic():
+            return heapq.heappop(self.timers)[2], ()
+        for qname, callback in self.consumers.items():
+            queue = self.queues.get(qname)
+            if queue:
+                exchange, routing_key, data, properties = queue.popleft()
+                self.delivery_tag += 1
+                method = types.SimpleNamespace(exchange=exchange, routing_key=routing_key,
+                                               delivery_tag=self.delivery_tag)
+                return callback, (self, method, properties, data)
+        return None, None
+
+    def process_data_events(self, time_limit=0):
+        """
+        Run callbacks, timers and deliveries that are ready, waiting up to time_limit
+        seconds for the first one.  Returns the number of items processed.
+        """
+        processed = 0
+        deadline = time.monotonic() + time_limit
+        while self.open:
+            with self.cond:
+                work, args = self.next_work()
+                if work is None:
+                    timeout = deadline - time.monotonic()
+                    if processed > 0 or timeout <= 0:
+                        break
+                    if self.timers:
+                        timeout = min(timeout, self.timers[0][0] - time.monotonic())
+                    self.cond.wait(max(timeout, 0))
+                    continue
+            work(*args)
+            processed += 1
+        return processed
+
+    def start_consuming(self):
+        while self.open:
+            with self.cond:
+                work, args = self.next_work()
+                if work is None:
+                    timeout = self.timers[0][0] - time.monotonic() if self.timers else None
+                    self.cond.wait(timeout)
+                    continue
+            work(*args)
+
+
+class _Lease:
+    # Held only by the owning thread's thread-local, so it is collected when the thread ends
+    def __init__(self, publisher):
+        self.publisher = publisher
+        self.finalizer = None
+
+
+class PublisherPool:
+    """
+    At most max_connections publish-only transports, each owned by the thread that first asked for one.
+    A thread that found the pool taken is told so for good, so every thread publishes all its messages
+    one way, keeping them in order.  A connection is closed and its slot freed when its thread ends.
+    """
+
+    def __init__(self, open_publisher, max_connections=4, publisher_confirms=False):
+        self.open_publisher = open_publisher
+        self.max_connections = max_connections
+        self.publisher_confirms = publisher_confirms
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.publishers = []
+
+    def publisher(self):
+        """
+        The calling thread's transport, or None when every connection is taken by other threads.
+        """
+        if getattr(self.local, 'queued', False):
+            return None
+        lease = getattr(self.local, 'lease', None)
+        if lease is None:
+            with self.lock:
+                if len(self.publishers) >= self.max_connections:
+                    self.local.queued = True
+                    return None
+                publisher = self.open_publisher()
+                if self.publisher_confirms:
+                    publisher.enable_confirms()
+                self.publishers.append(publisher)
+            lease = _Lease(publisher)
+            lease.finalizer = weakref.finalize(lease, self.release, publisher)
+            self.local.lease = lease
+        return lease.publisher
+
+    def give_up(self):
+        # The calling thread publishes through the consumer thread from now on
+        self.discard()
+        self.local.queued = True
+
+    def discard(self):
+        # Drop the calling thread's transport after a connection error, the next publish reconnects
+        lease = getattr(self.local, 'lease', None)
+        if lease is not None:
+            self.local.lease = None
+            lease.finalizer()
+
+    def release(self, publisher):
+        # Called once per lease, by discard or when the owning thread's thread-local goes away
+        with self.lock:
+            if publisher not in self.publishers:
+                return              # The pool was closed
+            self.publishers.remove(publisher)
+        try:
+            publisher.close()
+        except Exception:
+            pass                    # Already broken
+
+    def close(self):
+        with self.lock:
+            publishers, self.publishers = self.publishers, []
+        for publisher in publishers:
+            if publisher.is_open():
+                publisher.close()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Dynamic Object Language Labs Inc.
+#
+# This software is licensed under the terms of the
+# Apache License, Version 2.0 which can be found in
+# the file LICENSE at the root of this distribution.
+
+import numpy as np
+import gymnasium as gym
+
+'''
+Pool of gym environments, one per plant-id, stepped together through
+gymnasium's vector env API.
+
+Actions are latched per slot and the whole batch is stepped with one
+vectorized step() call once every active slot has an action pending.
+The pool is built with autoreset disabled so that each learner decides
+when its own slot is reset, exactly as with a single environment.
+
+A vector env with autoreset disabled refuses to step a sub-env whose
+episode ended until it is reset, yet every sub-env takes part in the
+batched step, including slots no learner uses.  Sub-envs whose episode
+ended are therefore reset just before the next batched step.  A learner
+that steps its slot again after the end of its episode, without a reset,
+gets the final step back with a zero reward, as the slot's env has moved
+on.
+'''
+
+
+class VecEnvPool:
+    def __init__(self, plantids, vectorization_mode='sync'):
+        self.plantids = list(plantids)
+        self.slots = {}
+        for i, pid in enumerate(self.plantids):
+            self.slots[pid] = i
+        self.num_envs = len(self.plantids)
+        self.vectorization_mode = vectorization_mode
+        self.envname = None
+        self.envs = None
+        self.goal_position = None   # of the env, when it has one, for episode success
+        self.active = set()     # plant-ids that have called make_env and not closed
+        self.pending = {}       # plant-id -> (action, msg) waiting for the next batched step
+        self.states = None      # last observation of every slot, shape (num_envs, num_obs)
+        self.needs_reset = np.zeros(self.num_envs, dtype=np.bool_)  # sub-env episode ended, not reset since
+        self.finished = np.zeros(self.num_envs, dtype=np.bool_)     # the learner's episode ended, not reset since
+        self.terminated = np.zeros(self.num_envs, dtype=np.bool_)   # flags of the learner's last step
+        self.truncated = np.zeros(self.num_envs, dtype=np.bool_)
+
+    def has_slot(self, plantid):
+        return plantid in self.slots
+
+    def make(self, envname, plantid):
+        # All slots share one vector env, so they must all run the same environment.
+        if self.envs is None:
+            self.envname = envname
+            self.envs = gym.make_vec(envname, num_envs=self.num_envs,
+                                     vectorization_mode=self.vectorization_mode,
+                                     vector_kwargs={'autoreset_mode': gym.vector.AutoresetMode.DISABLED})
+            self.states, _ = self.envs.reset()
+            self.goal_position = self.read_goal_position(envname)
+        elif envname != self.envname:
+            raise ValueError('pool is running ' + str(self.envname) + ', cannot make ' + str(envname))
+        self.active.add(plantid)
+        return self.slots[plantid]
+
+    def read_goal_position(self, envname):
+        # Not through get_attr: an AsyncVectorEnv worker that raises AttributeError is shut down
+        if self.vectorization_mode == 'sync':
+            return getattr(self.envs.envs[0].unwrapped, 'goal_position', None)
+        env = gym.make(envname)
+        try:
+            return getattr(env.unwrapped, 'goal_position', None)
+        finally:
+            env.close()
+
+    def observation_space(self):
+        return self.envs.single_observation_space
+
+    def action_space(self):
+        return self.envs.single_action_space
+
+    def reset(self, plantid):
+        i = self.slots[plantid]
+        mask = np.zeros(self.num_envs, dtype=np.bool_)
+        mask[i] = True
+        obs, _ = self.envs.reset(options={'reset_mask': mask})
+        self.states[i] = obs[i]
+        self.needs_reset[i] = False
+        self.finished[i] = False
+        return self.states[i]
+
+    def close(self, plantid):
+        """
+        Returns the (action, msg) that was pending for the slot, or None.
+        """
+        self.active.discard(plantid)
+        return self.pending.pop(plantid, None)
+
+    def shutdown(self):
+        if self.envs is not None:
+            self.envs.close()
+            self.envs = None
+
+    def latch(self, plantid, action, msg):
+        """
+        Returns False, latching nothing, if the slot already has an action pending.
+        """
+        if plantid in self.pending:
+            return False
+        self.pending[plantid] = (action, msg)
+        return True
+
+    def batch_ready(self):
+        return len(self.pending) > 0 and self.active.issubset(self.pending.keys())
+
+    def step_batch(self):
+        """
+        Step every slot with one vectorized step() call.
+        Returns a list of (plant-id, msg, state, reward, terminated, truncated).
+        """
+        if self.needs_reset.any():
+            # Idle and finished slots, their states are kept, the learner has not asked for a reset
+            self.envs.reset(options={'reset_mask': self.needs_reset.copy()})
+            self.needs_reset[:] = False
+        actions = np.zeros(self.num_envs, dtype=np.int64)
+        for pid, (action, _) in self.pending.items():
+            actions[self.slots[pid]] = action
+        obs, rewards, terminated, truncated, _ = self.envs.step(actions)
+        self.needs_reset |= terminated | truncated
+        results = []
+        for pid, (_, msg) in self.pending.items():
+            results.append(self.slot_result(pid, msg, obs[self.slots[pid]], rewards[self.slots[pid]],
+                                            terminated[self.slots[pid]], truncated[self.slots[pid]]))
+        self.pending = {}
+        return results
+
+    def step_partial(self):
+        """
+        Step only the slots that have an action pending, one at a time.
+        Only possible with the sync vectorizer, where the sub-environments
+        live in this process; the async vectorizer must run in lockstep.
+        Returns the same list as step_batch, or None when not possible.
+        """
+        if self.vectorization_mode != 'sync':
+            return None
+        results = []
+        for pid, (action, msg) in self.pending.items():
+            i = self.slots[pid]
+            if self.finished[i]:
+                results.append(self.slot_result(pid, msg, None, 0.0, False, False))
+                continue
+            state, reward, terminated, truncated, _ = self.envs.envs[i].step(action)
+            self.needs_reset[i] |= terminated or truncated
+            results.append(self.slot_result(pid, msg, state, reward, terminated, truncated))
+        self.pending = {}
+        return results
+
+    def slot_result(self, pid, msg, state, reward, terminated, truncated):
+        i = self.slots[pid]
+        if self.finished[i]:
+            # Stepped after the end of its episode, repeat the final step
+            return (pid, msg, self.states[i], 0.0, bool(self.terminated[i]), bool(self.truncated[i]))
+        self.states[i] = state
+        self.terminated[i] = terminated
+        self.truncated[i] = truncated
+        self.finished[i] = terminated or truncated
+        return (pid, msg, self.states[i], reward, bool(terminated), bool(truncated))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Dynamic Object Language Labs Inc.
+#
+# This software is licensed under the terms of the
+# Apache License, Version 2.0 which can be found in
+# the file LICENSE at the root of this distribution.
+
+import json
+import os
+import signal
+import socket
+import sys
+import time
+from pprint import pprint
+
+import gym_plant
+import env_cache
+
+'''
+Warm-start server for gym plants
+
+Imports gymnasium and the plant modules once, builds and resets the
+--preload envs, and then forks a ready plant for each spawn request, so a
+restarted plant skips the imports and gym.make.  Forked plants get the
+preloaded envs through their env cache and open their own RMQ connection;
+the server itself never connects.  With --metrics-port each plant serves
+its metrics on a port of its own, --metrics-port plus the lowest offset
+no running plant uses.
+
+Spawn requests are JSON lines on a unix socket, answered with the pid:
+
+    {"plantid": "dmrl-2"}           -> {"pid": 1234, "plantid": "dmrl-2"}
+
+    warm_plant.py --socket /tmp/gym-warm.sock --preload CartPole-v1 --spawn dmrl
+    warm_plant.py --socket /tmp/gym-warm.sock --request dmrl-2
+'''
+
+
+def preload_envs(names, cache_size):
+    envs = env_cache.EnvCache(max(cache_size, len(names)))
+    for name in names:
+        t0 = time.perf_counter()
+        envs.get(name).reset()
+        print('preloaded', name, 'in %.3f s' % (time.perf_counter() - t0))
+    return envs
+
+
+def run_plant(args, plantid, envs, forked, metrics_port_offset=0):
+    gym_plant.rmq = gym_plant.Rmq(plantid, args.exchange, args.host, args.port, args.encoding,
+                                  **gym_plant.make_plant_options(args))
+    gym_plant.configure(args, gym_plant.rmq, metrics_port_offset)
+    envs.max_idle = args.env_cache_size
+    gym_plant.rmq.envs = envs
+    gym_plant.report_startup(gym_plant.rmq, forked)
+    gym_plant.rmq.subscribe_and_wait()
+    gym_plant.on_gym_shutdown()
+
+
+class WarmServer:
+    def __init__(self, args, envs):
+        self.args = args
+        self.envs = envs
+        self.children = {}          # pid -> (plantid, metrics port offset)
+        self.stopping = False
+
+    def free_port_offset(self):
+        used = set(offset for plantid, offset in self.children.values())
+        offset = 0
+        while offset in used:
+            offset += 1
+        return offset
+
+    def spawn(self, plantid):
+        offset = self.free_port_offset()
+        forked = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                run_plant(self.args, plantid, self.envs, forked, offset)
+            except BaseException as e:
+                print('plant', plantid, 'failed', e.__class__.__name__ + ": " + str(e))
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = (plantid, offset)
+        print('forked plant', plantid, 'pid', pid)
+        return pid
+
+    def reap(self):
+        while self.children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            plantid, offset = self.children.pop(pid, (None, None))
+            print('plant', plantid, 'pid', pid, 'exited with status', status)
+
+    def handle(self, conn):
+        with conn:
+            line = conn.makefile('r').readline()
+            try:
+                request = json.loads(line)
+                reply = {'pid': self.spawn(request['plantid']), 'plantid': request['plantid']}
+            except (ValueError, KeyError) as e:
+                reply = {'error': e.__class__.__name__ + ": " + str(e)}
+            conn.sendall((json.dumps(reply) + '\n').encode('utf-8'))
+
+    def serve(self, path, poll_interval=0.5):
+        if os.path.exists(path):
+            os.unlink(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen()
+        server.settimeout(poll_interval)
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, 'stopping', True))
+        print('warm plant server on', path)
+        try:
+            while not self.stopping:
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    conn = None
+                if conn is not None:
+                    self.handle(conn)
+                self.reap()
+        except KeyboardInterrupt:
+            print("Keyboard interrupt, perhaps Control-C.")
+        server.close()
+        os.unlink(path)
+        self.stop()
+
+    def stop(self):
+        for pid in self.children:
+            os.kill(pid, signal.SIGTERM)
+        for pid in list(self.children):
+            os.waitpid(pid, 0)
+        print('stopped', len(self.children), 'plants')
+
+
+def request_spawn(path, plantid):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path)
+        conn.sendall((json.dumps({'plantid': plantid}) + '\n').encode('utf-8'))
+        return json.loads(conn.makefile('r').readline())
+
+
+def main(args):
+    if args.request is not None:
+        pprint(request_spawn(args.socket, args.request))
+        return
+    envs = preload_envs([name for name in args.preload.split(',') if name], args.env_cache_size)
+    print('warm in %.3f s' % (time.perf_counter() - gym_plant.startup_started))
+    server = WarmServer(args, envs)
+    for plantid in [p for p in args.spawn.split(',') if p]:
+        server.spawn(plantid)
+    server.serve(args.socket)
+    print('Done warm_plant main')
+
+
+if __name__ == "__main__":
+    parser = gym_plant.make_arg_parser('Warm-start Gym Plant server')
+    parser.add_argument('--socket', default='/tmp/gym-warm-plant.sock', help='unix socket for spawn requests')
+    parser.add_argument('--preload', default='', help='comma separated gym envs to build before forking')
+    parser.add_argument('--spawn', default='', help='comma separated plant ids to fork at startup')
+    parser.add_argument('--request', default=None,
+                        help='ask a running server to fork a plant with this plant id, then exit')
+    args = parser.parse_args()
+    if args.asyncio or args.num_envs > 0 or args.replay is not None:
+        parser.error('the warm server forks single env plants only')
+    pprint(args)
+    main(args)
+    sys.exit(0)